@@ -242,11 +242,13 @@ class Forest(AstronomicalObject):
     get_metadata_dtype
     get_metadata_units
     set_class_variables
+    update_grid_version
 
     Methods
     -------
     (see AstronomicalObject in py/picca/delta_extraction/astronomical_object.py)
     __init__
+    __getstate__
     consistency_check
     coadd
     get_data
@@ -260,6 +262,11 @@ class Forest(AstronomicalObject):
     blinding: str
     Name of the blinding strategy used
 
+    grid_version: int
+    Counter increased every time log_lambda_grid or log_lambda_rest_frame_grid
+    are replaced (see method update_grid_version). Used to invalidate the cached
+    binning solutions
+
     log_lambda_grid: array of float or None
     Common grid in log_lambda based on the specified minimum and maximum
     wavelengths, and pixelisation.
@@ -301,9 +308,22 @@ class Forest(AstronomicalObject):
     as the particular instance might not have full wavelength coverage or
     might have some missing pixels (because they are masked)
 
+    log_lambda_bins: array of int (property)
+    Bins of log_lambda in Forest.log_lambda_grid. Computed on first access and
+    cached until log_lambda or the grid change
+
     log_lambda_index: array of int or None
     Index of each log_lambda array element in Forest.log_lambda_grid
 
+    log_lambda_rest_frame_bins: array of int (property)
+    Bins of the rest-frame log_lambda in Forest.log_lambda_rest_frame_grid.
+    Computed on first access and cached until log_lambda, z or the grid change
+
+    log_lambda_rest_frame_interp: (array of int, array of float) (property)
+    Position of the rest-frame log_lambda in Forest.log_lambda_rest_frame_grid
+    to use in linear interpolations. Computed on first access and cached until
+    log_lambda, z or the grid change
+
     logger: logging.Logger
     Logger object
 
@@ -319,6 +339,8 @@ class Forest(AstronomicalObject):
     blinding = "none"
     find_bins = None # this will store the correct find_bins function
     flux_units = None
+    grid_version = 0
+    _grid_version_grids = (None, None)
     log_lambda_grid = np.array([])  #None
     log_lambda_rest_frame_grid = np.array([])  #None
     log_lambda_index = np.array([]) #None
@@ -374,6 +396,10 @@ class Forest(AstronomicalObject):
         if kwargs.get("weights") is not None:
             del kwargs["weights"]
 
+        # cached binning solutions (see properties log_lambda_bins and
+        # log_lambda_rest_frame_bins)
+        self._bins_cache = {}
+
         # call parent constructor
         super().__init__(**kwargs)
 
@@ -383,6 +409,123 @@ class Forest(AstronomicalObject):
         snr = self.flux * np.sqrt(self.ivar)
         self.mean_snr = np.mean(snr)
 
+    def __getstate__(self):
+        """Return the state to pickle
+
+        The cached binning solutions are not pickled: they are cheap to
+        recompute and refer to the grid version of this process
+
+        Return
+        ------
+        state: dict
+        The instance attributes without the cached binning solutions
+        """
+        state = self.__dict__.copy()
+        state["_bins_cache"] = {}
+        return state
+    def __get_cached(self, name, cache_key, function):
+        """Return a cached quantity, recomputing it if the cache is outdated
+
+        Arguments
+        ---------
+        name: str
+        Name of the cached quantity
+
+        cache_key: tuple
+        Objects the quantity depends on. The cached value is reused only if
+        all the items are the same objects (or equal values for scalars) as
+        those used to compute it. The class grids are included through
+        their version (see method update_grid_version).
+
+        function: callable
+        Function (without arguments) computing the quantity
+
+        Return
+        ------
+        value: object
+        The (possibly cached) quantity
+        """
+        cached = self._bins_cache.get(name)
+        if cached is None or any(
+                not (item is cached_item or
+                     (np.isscalar(item) and item == cached_item))
+                for item, cached_item in zip(cache_key, cached[0])):
+            cached = (cache_key, function())
+            self._bins_cache[name] = cached
+        return cached[1]
+
+    @property
+    def log_lambda_bins(self):
+        """Bins of log_lambda in Forest.log_lambda_grid
+
+        The bins are computed on first access and cached. The cache is
+        invalidated when log_lambda or Forest.log_lambda_grid are replaced.
+
+        Return
+        ------
+        bins: array of int
+        Bins of log_lambda with respect to Forest.log_lambda_grid
+        """
+        return self.__get_cached(
+            "obs", (self.log_lambda, Forest.update_grid_version()),
+            lambda: Forest.find_bins( # pylint: disable=not-callable
+                self.log_lambda, Forest.log_lambda_grid))
+
+    @property
+    def log_lambda_rest_frame_bins(self):
+        """Bins of the rest-frame log_lambda in Forest.log_lambda_rest_frame_grid
+
+        The bins are computed on first access and cached. The cache is
+        invalidated when log_lambda, z, or Forest.log_lambda_rest_frame_grid
+        are replaced.
+
+        Return
+        ------
+        bins: array of int
+        Bins of the rest-frame log_lambda with respect to
+        Forest.log_lambda_rest_frame_grid
+        """
+        return self.__get_cached(
+            "rest", (self.log_lambda, Forest.update_grid_version(), self.z),
+            lambda: Forest.find_bins( # pylint: disable=not-callable
+                self.log_lambda - np.log10(1 + self.z),
+                Forest.log_lambda_rest_frame_grid))
+
+    @property
+    def log_lambda_rest_frame_interp(self):
+        """Position of the rest-frame log_lambda in Forest.log_lambda_rest_frame_grid
+
+        The positions are given as the index of the grid node to the left and
+        the fractional distance to the next node, so that a function sampled
+        in the grid, f, is linearly interpolated as
+        f[index] + fraction * (f[index + 1] - f[index]).
+        The positions are computed on first access and cached. The cache is
+        invalidated when log_lambda, z, or Forest.log_lambda_rest_frame_grid
+        are replaced.
+
+        Return
+        ------
+        index: array of int
+        Index of the grid node to the left of each pixel
+
+        fraction: array of float
+        Fractional position of each pixel between nodes index and index + 1
+        """
+        def compute_positions():
+            log_lambda_rest_frame = self.log_lambda - np.log10(1 + self.z)
+            grid = Forest.log_lambda_rest_frame_grid
+            index = np.clip(
+                np.searchsorted(grid, log_lambda_rest_frame, side="right") - 1,
+                0, grid.size - 2)
+            fraction = ((log_lambda_rest_frame - grid[index]) /
+                        (grid[index + 1] - grid[index]))
+            return index, fraction
+
+        return self.__get_cached(
+            "rest interp",
+            (self.log_lambda, Forest.update_grid_version(), self.z),
+            compute_positions)
+
     @classmethod
     def class_variable_check(cls):
         """Check that class variables have been correctly initialized"""
@@ -681,6 +824,26 @@ class Forest(AstronomicalObject):
         # required
         return rebin_ivar, orig_ivar, w1, w2, wslice_inner, bins
 
+    @classmethod
+    def update_grid_version(cls):
+        """Update and return the version of the wavelength grids
+
+        Forest.grid_version is increased if Forest.log_lambda_grid or
+        Forest.log_lambda_rest_frame_grid were replaced since the last call,
+        either through set_class_variables or by direct assignment.
+
+        Return
+        ------
+        grid_version: int
+        The version of the wavelength grids
+        """
+        grids = (Forest.log_lambda_grid, Forest.log_lambda_rest_frame_grid)
+        if any(grid is not known_grid for grid, known_grid in zip(
+                grids, Forest._grid_version_grids)):
+            Forest.grid_version += 1
+            Forest._grid_version_grids = grids
+        return Forest.grid_version
+
     @classmethod
     def set_class_variables(cls, lambda_min, lambda_max, lambda_min_rest_frame,
                             lambda_max_rest_frame, pixel_step,
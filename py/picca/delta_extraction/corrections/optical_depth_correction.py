@@ -93,12 +93,15 @@ class OpticalDepthCorrection(Correction):
         forest: Forest
         A Forest instance to which the correction is applied
         """
-        mean_optical_depth = np.ones(forest.log_lambda.size)
+        # the optical depths of all the absorbers are added up and then
+        # exponentiated once. Note that 1 + z = lambda / lambda_rest_frame
+        lambda_ = 10.**forest.log_lambda
+        lambda_rest_frame_forest = lambda_ / (1. + forest.z)
+        optical_depth = np.zeros(forest.log_lambda.size)
         for tau, gamma, lambda_rest_frame in zip(self.tau_list, self.gamma_list,
                                                  self.lambda_rest_frame_list):
 
-            w = 10.**forest.log_lambda / (1. + forest.z) <= lambda_rest_frame
-            z = 10.**forest.log_lambda / lambda_rest_frame - 1.
-            mean_optical_depth[w] *= np.exp(-tau * (1. + z[w])**gamma)
+            w = lambda_rest_frame_forest <= lambda_rest_frame
+            optical_depth[w] += tau * (lambda_[w] / lambda_rest_frame)**gamma
 
-        forest.transmission_correction *= mean_optical_depth
+        forest.transmission_correction *= np.exp(-optical_depth)
@@ -370,7 +370,7 @@ class DesiDataFileHandler():
                         else:
                             reso_sum = spec['RESO'][w_t].sum(axis=0)
                     reso_in_pix, reso_in_km_per_s = spectral_resolution_desi(
-                        reso_sum, spec['WAVELENGTH'])
+                        reso_sum, spec['WAVELENGTH'], args["log_lambda"])
                     args["exposures_diff"] = exposures_diff
                     args["reso"] = reso_in_km_per_s
                     args["resolution_matrix"] = reso_sum
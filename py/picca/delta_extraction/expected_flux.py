@@ -11,6 +11,7 @@ from scipy.interpolate import interp1d
 from picca.delta_extraction.astronomical_objects.forest import Forest
 from picca.delta_extraction.astronomical_objects.pk1d_forest import Pk1dForest
 from picca.delta_extraction.errors import ExpectedFluxError, AstronomicalObjectError
+from picca.delta_extraction.utils import LinearInterpolator, stack_pixels
 
 accepted_options = [
     "iter out prefix", "num bins variance", "num processors", "out dir",
@@ -24,6 +25,9 @@ defaults = {
     "var lss mod": 1.0,
 }
 
+# number of forests whose contributions are added together when stacking
+STACK_CHUNK_SIZE = 1000
+
 
 class ExpectedFlux:
     """Abstract class from which all classes computing the expected flux
@@ -42,6 +46,7 @@ class ExpectedFlux:
     _compute_mean_cont
     compute_forest_weights
     extract_deltas
+    get_stack_delta_grid
     hdu_cont
     hdu_fit_metadata
     hdu_var_func
@@ -95,11 +100,18 @@ class ExpectedFlux:
         # initialize mean continuum
         self.get_mean_cont = None
         self.get_mean_cont_weight = None
+        # values of get_mean_cont and get_mean_cont_weight in
+        # Forest.log_lambda_rest_frame_grid, kept to write the results
+        self._mean_cont_grid = None
+        self._mean_cont_weight_grid = None
         self._initialize_mean_continuum_arrays()
 
         # to store the stack of deltas
         self.get_stack_delta = None
         self.get_stack_delta_weights = None
+        # values of the stack of deltas in Forest.log_lambda_grid
+        # (see method get_stack_delta_grid)
+        self._stack_delta_grid = None
 
     def _initialize_mean_continuum_arrays(self):
         """Initialize mean continuum arrays
@@ -110,13 +122,16 @@ class ExpectedFlux:
         # initialize the mean quasar continuum
         # TODO: maybe we can drop this and compute first the mean quasar
         # continuum on compute_expected_flux
-        self.get_mean_cont = interp1d(Forest.log_lambda_rest_frame_grid,
-                                      np.ones_like(
-                                          Forest.log_lambda_rest_frame_grid),
-                                      fill_value="extrapolate")
-        self.get_mean_cont_weight = interp1d(
+        self._mean_cont_grid = np.ones_like(Forest.log_lambda_rest_frame_grid)
+        self._mean_cont_weight_grid = np.zeros_like(
+            Forest.log_lambda_rest_frame_grid)
+        self.get_mean_cont = LinearInterpolator(
+            Forest.log_lambda_rest_frame_grid,
+            self._mean_cont_grid,
+            fill_value="extrapolate")
+        self.get_mean_cont_weight = LinearInterpolator(
             Forest.log_lambda_rest_frame_grid,
-            np.zeros_like(Forest.log_lambda_rest_frame_grid),
+            self._mean_cont_weight_grid,
             fill_value="extrapolate")
 
     def _initialize_variance_wavelength_array(self):
@@ -201,24 +216,35 @@ class ExpectedFlux:
         stack_delta = np.zeros_like(Forest.log_lambda_grid)
         stack_weight = np.zeros_like(Forest.log_lambda_grid)
 
-        for forest in forests:
-            if stack_from_deltas:
-                delta = forest.delta
-                weights = forest.weights
-            else:
-                # ignore forest if continuum could not be computed
-                if forest.continuum is None:
-                    continue
-
-                delta = np.zeros_like(forest.log_lambda)
-                w = forest.ivar > 0
-                delta[w] = forest.flux[w] / forest.continuum[w]
-                weights = self.compute_forest_weights(forest, forest.continuum)
-
-            bins = Forest.find_bins( # pylint: disable=not-callable
-                forest.log_lambda, Forest.log_lambda_grid)
-            stack_delta += np.bincount(bins, weights=delta * weights, minlength=stack_delta.size)
-            stack_weight += np.bincount(bins, weights=weights, minlength=stack_delta.size)
+        # forests are stacked in chunks: the contributions of all the forests
+        # in a chunk are concatenated and added in a single pass
+        for start in range(0, len(forests), STACK_CHUNK_SIZE):
+            bins = []
+            deltas = []
+            weights = []
+            for forest in forests[start:start + STACK_CHUNK_SIZE]:
+                if stack_from_deltas:
+                    delta = forest.delta
+                    forest_weights = forest.weights
+                else:
+                    # ignore forest if continuum could not be computed
+                    if forest.continuum is None:
+                        continue
+
+                    delta = np.zeros_like(forest.log_lambda)
+                    w = forest.ivar > 0
+                    delta[w] = forest.flux[w] / forest.continuum[w]
+                    forest_weights = self.compute_forest_weights(
+                        forest, forest.continuum)
+
+                bins.append(forest.log_lambda_bins)
+                deltas.append(delta)
+                weights.append(forest_weights)
+
+            if len(bins) == 0:
+                continue
+            stack_pixels(np.concatenate(bins), np.concatenate(deltas),
+                         np.concatenate(weights), stack_delta, stack_weight)
 
         w = stack_weight > 0
         stack_delta[w] /= stack_weight[w]
@@ -273,23 +299,23 @@ class ExpectedFlux:
         # (and Cont_old is constant for all spectra in a bin), thus we actually
         # compute
         #    1/Cont_old * <F/spectrum_dependent_fitting_function>
-        for forest in forests:
-            if forest.bad_continuum_reason is not None:
+        # as in compute_delta_stack, forests are added in chunks
+        for start in range(0, len(forests), STACK_CHUNK_SIZE):
+            bins = []
+            continua = []
+            weights = []
+            for forest in forests[start:start + STACK_CHUNK_SIZE]:
+                if forest.bad_continuum_reason is not None:
+                    continue
+                bins.append(forest.log_lambda_rest_frame_bins)
+                continua.append(which_cont(forest))
+                weights.append(
+                    self.compute_forest_weights(forest, forest.continuum))
+
+            if len(bins) == 0:
                 continue
-            bins = Forest.find_bins( # pylint: disable=not-callable
-                forest.log_lambda - np.log10(1 + forest.z),
-                Forest.log_lambda_rest_frame_grid)
-
-            weights = self.compute_forest_weights(forest, forest.continuum)
-            forest_continuum = which_cont(forest)
-            mean_cont += np.bincount(
-                bins,
-                weights=forest_continuum * weights,
-                minlength=mean_cont.size)
-            mean_cont_weight += np.bincount(
-                bins,
-                weights=weights,
-                minlength=mean_cont.size)
+            stack_pixels(np.concatenate(bins), np.concatenate(continua),
+                         np.concatenate(weights), mean_cont, mean_cont_weight)
 
         w = mean_cont_weight > 0
         mean_cont[w] /= mean_cont_weight[w]
@@ -299,13 +325,24 @@ class ExpectedFlux:
         # the new mean continuum is multiplied by the previous one to recover
         # <F/spectrum_dependent_fitting_function>
         new_cont = self.get_mean_cont(log_lambda_cont) * mean_cont[w]
-        self.get_mean_cont = interp1d(log_lambda_cont,
+        # the mean continuum is sampled in the full rest-frame grid. Since empty
+        # bins are linearly interpolated, this describes exactly the same
+        # function, and allows to use Forest.log_lambda_rest_frame_interp
+        # when evaluating it
+        new_cont = LinearInterpolator(log_lambda_cont,
                                       new_cont,
-                                      fill_value="extrapolate")
-        self.get_mean_cont_weight = interp1d(log_lambda_cont,
-                                             mean_cont_weight[w],
-                                             fill_value=0.0,
-                                             bounds_error=False)
+                                      fill_value="extrapolate")(
+                                          Forest.log_lambda_rest_frame_grid)
+        self.get_mean_cont = LinearInterpolator(
+            Forest.log_lambda_rest_frame_grid,
+            new_cont,
+            fill_value="extrapolate")
+        self.get_mean_cont_weight = LinearInterpolator(log_lambda_cont,
+                                                       mean_cont_weight[w],
+                                                       fill_value=0.0)
+        self._mean_cont_grid = new_cont
+        self._mean_cont_weight_grid = self.get_mean_cont_weight(
+            Forest.log_lambda_rest_frame_grid)
 
     def compute_forest_weights(self, forest, continuum):
         """Compute the forest weights
@@ -348,6 +385,27 @@ class ExpectedFlux:
 
             forest.continuum = self.los_ids.get(forest.los_id).get("continuum")
 
+    def get_stack_delta_grid(self):
+        """Get the values of the stack of deltas in Forest.log_lambda_grid
+
+        Forest pixels lie on Forest.log_lambda_grid, so the stack for a forest
+        is obtained indexing these values with Forest.log_lambda_bins.
+        Values are computed once and cached. The cache is refreshed whenever
+        get_stack_delta or the grid are replaced.
+
+        Return
+        ------
+        stack_delta: array of float
+        Values of get_stack_delta in Forest.log_lambda_grid
+        """
+        cache_key = (self.get_stack_delta, Forest.log_lambda_grid)
+        if (self._stack_delta_grid is None or any(
+                item is not cached_item for item, cached_item in zip(
+                    cache_key, self._stack_delta_grid[0]))):
+            self._stack_delta_grid = (
+                cache_key, self.get_stack_delta(Forest.log_lambda_grid))
+        return self._stack_delta_grid[1]
+
     def hdu_cont(self, results):
         """Add to the results file an HDU with the continuum information
 
@@ -358,8 +416,8 @@ class ExpectedFlux:
         """
         results.write([
             Forest.log_lambda_rest_frame_grid,
-            self.get_mean_cont(Forest.log_lambda_rest_frame_grid),
-            self.get_mean_cont_weight(Forest.log_lambda_rest_frame_grid),
+            self._mean_cont_grid,
+            self._mean_cont_weight_grid,
         ],
                       names=['LOGLAM_REST', 'MEAN_CONT', 'WEIGHT'],
                       units=['log(Angstrom)', Forest.flux_units, ''],
@@ -428,10 +486,12 @@ class ExpectedFlux:
         iteration: int
         Iteration number. -1 for final iteration
         """
+        # intermediate steps are not compressed to avoid the gzip overhead on
+        # each iteration, only the final results are
         if iteration == -1:
             iter_out_file = self.iter_out_prefix + ".fits.gz"
         else:
-            iter_out_file = self.iter_out_prefix + f"_iteration{iteration+1}.fits.gz"
+            iter_out_file = self.iter_out_prefix + f"_iteration{iteration+1}.fits"
 
         with fitsio.FITS(self.out_dir + iter_out_file, 'rw',
                          clobber=True) as results:
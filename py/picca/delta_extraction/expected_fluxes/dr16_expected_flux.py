@@ -3,23 +3,24 @@ import logging
 import multiprocessing
 import time
 
-import iminuit
 import numpy as np
 from scipy.interpolate import interp1d
 
+from picca.delta_extraction.astronomical_objects.forest import Forest
 from picca.delta_extraction.astronomical_objects.pk1d_forest import Pk1dForest
 from picca.delta_extraction.errors import ExpectedFluxError
 from picca.delta_extraction.expected_flux import ExpectedFlux, defaults, accepted_options
-from picca.delta_extraction.expected_fluxes.utils import compute_continuum
+from picca.delta_extraction.expected_fluxes.utils import (
+    compute_continuum, compute_var_func_bin, compute_weights)
 from picca.delta_extraction.least_squares.least_squares_var_stats import (
-    LeastsSquaresVarStats, FUDGE_REF)
+    LeastsSquaresVarStats)
 from picca.delta_extraction.utils import (update_accepted_options,
                                           update_default_options)
 
 accepted_options = update_accepted_options(accepted_options, [
     "force stack delta to zero", "limit eta", "limit var lss",
     "min num qso in fit", "num iterations", "order", "use constant weight",
-    "use ivar as weight"
+    "use ivar as weight", "variance fitter"
 ])
 
 defaults = update_default_options(
@@ -32,12 +33,47 @@ defaults = update_default_options(
         "order": 1,
         "use constant weight": False,
         "use ivar as weight": False,
+        "variance fitter": "iminuit",
     })
 
 FUDGE_DEFAULT = 0
 ETA_DEFAULT = 1.
 VAR_LSS_DEFAULT = 0.1
 
+# fitter shared with the worker processes fitting the variance functions
+# (see Dr16ExpectedFlux.compute_var_stats)
+_worker_leasts_squares = None # pylint: disable=invalid-name
+
+
+def _init_var_stats_worker(leasts_squares):
+    """Store the fitter shared with a worker process fitting the variance
+    functions. Workers are forked, so the fitter is inherited without being
+    pickled
+
+    Arguments
+    ---------
+    leasts_squares: LeastsSquaresVarStats
+    The fitter class, initialized with the statistics of the deltas
+    """
+    global _worker_leasts_squares # pylint: disable=global-statement,invalid-name
+    _worker_leasts_squares = leasts_squares
+
+
+def _compute_var_func_bin_worker(*args):
+    """Fit the variance functions in one bin in a worker process
+
+    Arguments
+    ---------
+    *args: tuple
+    Arguments of compute_var_func_bin, except for the fitter class
+
+    Return
+    ------
+    fit_results: tuple
+    See compute_var_func_bin
+    """
+    return compute_var_func_bin(_worker_leasts_squares, *args)
+
 
 class Dr16ExpectedFlux(ExpectedFlux):
     """Class to the expected flux as done in the DR16 SDSS analysys
@@ -61,6 +97,7 @@ class Dr16ExpectedFlux(ExpectedFlux):
     compute_expected_flux
     compute_var_stats
     get_continuum_weights
+    get_variance_functions_grid
     hdu_cont
     hdu_stack_deltas
     hdu_var_func
@@ -71,11 +108,17 @@ class Dr16ExpectedFlux(ExpectedFlux):
     ----------
     (see ExpectedFlux in py/picca/delta_extraction/expected_flux.py)
 
-    continuum_fit_parameters: dict
-    A dictionary containing the continuum fit parameters for each line of sight.
-    Keys are the identifier for the line of sight and values are tuples with
-    the best-fit zero point and slope of the linear part of the fit, the chi2
-    of the fit, and the number of datapoints used in the fit..
+    continuum_fit_los_ids: array of int or None
+    Identifiers of the lines of sight, in the same order as the rows of
+    continuum_fit_parameters.
+
+    continuum_fit_parameters: array of float or None
+    Array of shape (num_forests, 4) containing the continuum fit parameters for
+    each forest. Columns are the best-fit zero point and slope of the
+    linear part of the fit, the chi2 of the fit, and the number of datapoints
+    used in the fit. Rows of forests that were not fitted are NaN. Forests
+    sharing a line of sight identifier have one row each; only the last one
+    is written by hdu_fit_metadata.
 
     get_eta: scipy.interpolate.interp1d
     Interpolation function to compute mapping function eta. See equation 4 of
@@ -85,10 +128,10 @@ class Dr16ExpectedFlux(ExpectedFlux):
     Interpolation function to compute mapping function fudge. See equation 4 of
     du Mas des Bourboux et al. 2020 for details.
 
-    get_mean_cont: scipy.interpolate.interp1d
+    get_mean_cont: LinearInterpolator
     Interpolation function to compute the unabsorbed mean quasar continua.
 
-    get_mean_cont_weight: scipy.interpolate.interp1d
+    get_mean_cont_weight: LinearInterpolator
     Interpolation function to compute the weights associated with the unabsorbed
     mean quasar continua.
 
@@ -114,7 +157,7 @@ class Dr16ExpectedFlux(ExpectedFlux):
     iter_out_prefix: str
     Prefix of the iteration files. These files contain the statistical properties
     of deltas at a given iteration step. Intermediate files will add
-    '_iteration{num}.fits.gz' to the prefix for intermediate steps and '.fits.gz'
+    '_iteration{num}.fits' to the prefix for intermediate steps and '.fits.gz'
     for the final results.
 
     limit_eta: tuple of floats
@@ -153,6 +196,10 @@ class Dr16ExpectedFlux(ExpectedFlux):
     use_ivar_as_weight: boolean
     If "True", use ivar as weights (implemented as eta = 1, sigma_lss = fudge = 0).
 
+    variance_fitter: str
+    Minimizer used to fit the variance functions. Either "iminuit" (migrad)
+    or "scipy" (scipy.optimize.least_squares).
+
     force_stack_delta_to_zero: boolean
     If "True", continuum is corrected by stack_delta.
     """
@@ -181,6 +228,7 @@ class Dr16ExpectedFlux(ExpectedFlux):
         self.use_constant_weight = None
         self.use_ivar_as_weight = None
         self.force_stack_delta_to_zero = None
+        self.variance_fitter = None
         self.__parse_config(config)
 
         # initialize variance functions
@@ -191,7 +239,11 @@ class Dr16ExpectedFlux(ExpectedFlux):
         self.get_var_lss = None
         self.fit_variance_functions = []
         self._initialize_variance_functions()
+        # values of the variance functions in Forest.log_lambda_grid
+        # (see method get_variance_functions_grid)
+        self._variance_functions_grid = None
 
+        self.continuum_fit_los_ids = None
         self.continuum_fit_parameters = None
 
     def _initialize_get_eta(self):
@@ -376,6 +428,16 @@ class Dr16ExpectedFlux(ExpectedFlux):
                 "Dr16FixedEtaVarlssFudgeExpectedFlux with options 'eta = 1', "
                 "'var lss = 0' and 'fudge = 0'")
 
+        self.variance_fitter = config.get("variance fitter")
+        if self.variance_fitter is None:
+            raise ExpectedFluxError(
+                "Missing argument 'variance fitter' required by Dr16ExpectedFlux"
+            )
+        if self.variance_fitter not in ["iminuit", "scipy"]:
+            raise ExpectedFluxError(
+                "Unrecognised value for 'variance fitter'. Expected either "
+                f"'iminuit' or 'scipy'. Found '{self.variance_fitter}'.")
+
     def compute_expected_flux(self, forests):
         """Compute the mean expected flux of the forests.
         This includes the quasar continua and the mean transimission. It is
@@ -387,77 +449,91 @@ class Dr16ExpectedFlux(ExpectedFlux):
         forests: List of Forest
         A list of Forest from which to compute the deltas.
         """
-        context = multiprocessing.get_context('fork')
-        for iteration in range(self.num_iterations):
-            self.logger.progress(
-                f"Continuum fitting: starting iteration {iteration} of {self.num_iterations}"
-            )
-            t0 = time.time()
-            self.logger.info(
-                f"Computing quasar continua using {self.num_processors} processors")
-            if self.num_processors > 1:
-                with context.Pool(processes=self.num_processors) as pool:
+        # the fit parameters are stored in a single preallocated array
+        # which is overwritten in each iteration
+        self.continuum_fit_los_ids = np.array(
+            [forest.los_id for forest in forests])
+        self.continuum_fit_parameters = np.full((len(forests), 4), np.nan)
+
+        # the pool is created once and reused in all iterations. The updated
+        # mean continuum and variance functions reach the workers through the
+        # arguments passed to compute_continuum
+        pool = None
+        if self.num_processors > 1:
+            context = multiprocessing.get_context('fork')
+            pool = context.Pool(processes=self.num_processors)
+        try:
+            for iteration in range(self.num_iterations):
+                self.logger.progress(
+                    f"Continuum fitting: starting iteration {iteration} of {self.num_iterations}"
+                )
+                t0 = time.time()
+                self.logger.info(
+                    f"Computing quasar continua using {self.num_processors} processors")
+                if pool is not None:
                     arguments = [(forest, self.get_mean_cont, self.get_eta,
                                   self.get_var_lss, self.get_fudge,
                                   self.use_constant_weight, self.order)
                                  for forest in forests]
                     imap_it = pool.starmap(compute_continuum, arguments)
 
-                    self.continuum_fit_parameters = {}
-                    for forest, (cont_model, bad_continuum_reason,
-                                 continuum_fit_parameters) in zip(
-                                     forests, imap_it):
+                    for index, (forest, (cont_model, bad_continuum_reason,
+                                         continuum_fit_parameters)) in enumerate(
+                                             zip(forests, imap_it)):
                         forest.bad_continuum_reason = bad_continuum_reason
                         forest.continuum = cont_model
                         self.continuum_fit_parameters[
-                            forest.los_id] = continuum_fit_parameters
+                            index] = continuum_fit_parameters
 
-            else:
-                self.continuum_fit_parameters = {}
-                for forest in forests:
-                    (cont_model, bad_continuum_reason,
-                     continuum_fit_parameters) = compute_continuum(
-                         forest, self.get_mean_cont, self.get_eta,
-                         self.get_var_lss, self.get_fudge,
-                         self.use_constant_weight, self.order)
-
-                    forest.bad_continuum_reason = bad_continuum_reason
-                    forest.continuum = cont_model
-                    self.continuum_fit_parameters[
-                        forest.los_id] = continuum_fit_parameters
-            t1 = time.time()
-            self.logger.info(f"Time spent computing quasar continua: {t1-t0}")
-
-            if iteration < self.num_iterations - 1:
-                # Compute mean continuum (stack in rest-frame)
-                t0 = time.time()
-                self.compute_mean_cont(forests)
+                else:
+                    for index, forest in enumerate(forests):
+                        (cont_model, bad_continuum_reason,
+                         continuum_fit_parameters) = compute_continuum(
+                             forest, self.get_mean_cont, self.get_eta,
+                             self.get_var_lss, self.get_fudge,
+                             self.use_constant_weight, self.order)
+
+                        forest.bad_continuum_reason = bad_continuum_reason
+                        forest.continuum = cont_model
+                        self.continuum_fit_parameters[
+                            index] = continuum_fit_parameters
                 t1 = time.time()
-                self.logger.info(f"Time spent computing the mean continuum: {t1-t0}")
+                self.logger.info(f"Time spent computing quasar continua: {t1-t0}")
 
-                # Compute observer-frame mean quantities (var_lss, eta, fudge)
-                if not (self.use_ivar_as_weight or self.use_constant_weight):
+                if iteration < self.num_iterations - 1:
+                    # Compute mean continuum (stack in rest-frame)
                     t0 = time.time()
-                    self.compute_var_stats(forests)
+                    self.compute_mean_cont(forests)
                     t1 = time.time()
-                    self.logger.info(
-                        f"Time spent computing eta, var_lss and fudge: {t1-t0}")
-
-            # compute the mean deltas
-            t0 = time.time()
-            self.compute_delta_stack(forests)
-            t1 = time.time()
-            self.logger.info(f"Time spent computing delta stack: {t1-t0}")
-
-            # Save the iteration step
-            if iteration == self.num_iterations - 1:
-                self.save_iteration_step(-1)
-            else:
-                self.save_iteration_step(iteration)
+                    self.logger.info(f"Time spent computing the mean continuum: {t1-t0}")
 
-            self.logger.progress(
-                f"Continuum fitting: ending iteration {iteration} of "
-                f"{self.num_iterations}")
+                    # Compute observer-frame mean quantities (var_lss, eta, fudge)
+                    if not (self.use_ivar_as_weight or self.use_constant_weight):
+                        t0 = time.time()
+                        self.compute_var_stats(forests)
+                        t1 = time.time()
+                        self.logger.info(
+                            f"Time spent computing eta, var_lss and fudge: {t1-t0}")
+
+                # compute the mean deltas
+                t0 = time.time()
+                self.compute_delta_stack(forests)
+                t1 = time.time()
+                self.logger.info(f"Time spent computing delta stack: {t1-t0}")
+
+                # Save the iteration step
+                if iteration == self.num_iterations - 1:
+                    self.save_iteration_step(-1)
+                else:
+                    self.save_iteration_step(iteration)
+
+                self.logger.progress(
+                    f"Continuum fitting: ending iteration {iteration} of "
+                    f"{self.num_iterations}")
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         # now loop over forests to populate los_ids
         self.populate_los_ids(forests)
@@ -473,18 +549,40 @@ class Dr16ExpectedFlux(ExpectedFlux):
         continuum: array of float
         Quasar continuum associated with the forest
         """
-        w = forest.ivar > 0
-        weights = np.empty_like(forest.log_lambda)
-        weights[~w] = 0.0
+        # forest pixels are on Forest.log_lambda_grid, so the variance
+        # functions are looked up from their values on the grid
+        eta_grid, var_lss_grid, fudge_grid = self.get_variance_functions_grid()
+        return compute_weights(forest.log_lambda_bins, forest.ivar, continuum,
+                               eta_grid, var_lss_grid, fudge_grid,
+                               self.var_lss_mod)
+
+    def get_variance_functions_grid(self):
+        """Get the values of eta, var_lss and fudge in Forest.log_lambda_grid
 
-        var_pipe = 1. / forest.ivar[w] / continuum[w]**2
-        var_lss = self.get_var_lss(forest.log_lambda[w])
-        eta = self.get_eta(forest.log_lambda[w])
-        fudge = self.get_fudge(forest.log_lambda[w])
-        weights[w] = 1.0/(
-            eta * var_pipe + self.var_lss_mod*var_lss + fudge / var_pipe)
+        Values are computed once and cached. The cache is refreshed whenever
+        any of the functions or the grid are replaced.
 
-        return weights
+        Return
+        ------
+        eta: array of float
+        Values of get_eta in Forest.log_lambda_grid
+
+        var_lss: array of float
+        Values of get_var_lss in Forest.log_lambda_grid
+
+        fudge: array of float
+        Values of get_fudge in Forest.log_lambda_grid
+        """
+        cache_key = (self.get_eta, self.get_var_lss, self.get_fudge,
+                     Forest.log_lambda_grid)
+        if (self._variance_functions_grid is None or any(
+                item is not cached_item for item, cached_item in zip(
+                    cache_key, self._variance_functions_grid[0]))):
+            values = (self.get_eta(Forest.log_lambda_grid),
+                      self.get_var_lss(Forest.log_lambda_grid),
+                      self.get_fudge(Forest.log_lambda_grid))
+            self._variance_functions_grid = (cache_key, values)
+        return self._variance_functions_grid[1]
 
     # TODO: We should check if we can directly compute the mean continuum
     # in particular this means:
@@ -530,13 +628,34 @@ class Dr16ExpectedFlux(ExpectedFlux):
         """
         if len(self.fit_variance_functions) > 0:
             # initialize arrays
-            eta = self.get_eta(self.log_lambda_var_func_grid)
-            var_lss = self.get_var_lss(self.log_lambda_var_func_grid)
-            fudge = self.get_fudge(self.log_lambda_var_func_grid)
-            num_pixels = np.zeros(self.num_bins_variance)
-            valid_fit = np.zeros(self.num_bins_variance)
-
-            chi2_in_bin = np.zeros(self.num_bins_variance)
+            # the statistics of each wavelength bin are stored contiguously
+            # in a single array. Columns are eta, var_lss, fudge, num_pixels,
+            # valid_fit and chi2_in_bin
+            var_stats = np.zeros((self.num_bins_variance, 6))
+            eta = var_stats[:, 0]
+            var_lss = var_stats[:, 1]
+            fudge = var_stats[:, 2]
+            num_pixels = var_stats[:, 3]
+            valid_fit = var_stats[:, 4]
+            chi2_in_bin = var_stats[:, 5]
+            eta[:] = self.get_eta(self.log_lambda_var_func_grid)
+            var_lss[:] = self.get_var_lss(self.log_lambda_var_func_grid)
+            fudge[:] = self.get_fudge(self.log_lambda_var_func_grid)
+
+            # bins where the previous fit failed were reset to the default
+            # values. Since the variance functions are smooth, start their fits
+            # from the closest bin with a valid fit instead
+            previous_valid_fit = self.get_valid_fit(
+                self.log_lambda_var_func_grid).astype(bool)
+            if previous_valid_fit.any():
+                valid_index = np.flatnonzero(previous_valid_fit)
+                closest_valid_index = valid_index[np.abs(
+                    np.arange(self.num_bins_variance)[:, np.newaxis] -
+                    valid_index).argmin(axis=1)]
+                for name, values in zip(["eta", "var_lss", "fudge"],
+                                        [eta, var_lss, fudge]):
+                    if name in self.fit_variance_functions:
+                        values[:] = values[closest_valid_index]
 
             # initialize the fitter class
             leasts_squares = LeastsSquaresVarStats(
@@ -549,42 +668,40 @@ class Dr16ExpectedFlux(ExpectedFlux):
             self.logger.progress(" Mean quantities in observer-frame")
             self.logger.progress(
                 " loglam    eta      var_lss  fudge    chi2     num_pix valid_fit")
-            for index in range(self.num_bins_variance):
-                leasts_squares.set_fit_bins(index)
-
-                minimizer = iminuit.Minuit(leasts_squares,
-                                           name=("eta", "var_lss", "fudge"),
-                                           eta=eta[index],
-                                           var_lss=var_lss[index],
-                                           fudge=fudge[index] / FUDGE_REF)
-                minimizer.errors["eta"] = 0.05
-                minimizer.limits["eta"] = self.limit_eta
-                minimizer.errors["var_lss"] = 0.05
-                minimizer.limits["var_lss"] = self.limit_var_lss
-                minimizer.errors["fudge"] = 0.05
-                minimizer.limits["fudge"] = (0, None)
-                minimizer.errordef = 1.
-                minimizer.print_level = 0
-                minimizer.fixed["eta"] = "eta" not in self.fit_variance_functions
-                minimizer.fixed[
-                    "var_lss"] = "var_lss" not in self.fit_variance_functions
-                minimizer.fixed[
-                    "fudge"] = "fudge" not in self.fit_variance_functions
-                minimizer.migrad()
-
-                if minimizer.valid:
-                    minimizer.hesse()
-                    eta[index] = minimizer.values["eta"]
-                    var_lss[index] = minimizer.values["var_lss"]
-                    fudge[index] = minimizer.values["fudge"] * FUDGE_REF
+            # bins are fitted independently, so the fits can run in parallel.
+            # forked workers inherit the fitter (and the forests it holds)
+            # through the pool initializer, so it is not pickled for each bin
+            arguments = [(index, eta[index], var_lss[index], fudge[index],
+                          self.limit_eta, self.limit_var_lss,
+                          self.fit_variance_functions, self.variance_fitter)
+                         for index in range(self.num_bins_variance)]
+            if self.num_processors > 1:
+                context = multiprocessing.get_context('fork')
+                with context.Pool(processes=self.num_processors,
+                                  initializer=_init_var_stats_worker,
+                                  initargs=(leasts_squares,)) as pool:
+                    fit_results = pool.starmap(_compute_var_func_bin_worker,
+                                               arguments)
+            else:
+                fit_results = [
+                    compute_var_func_bin(leasts_squares, *args)
+                    for args in arguments
+                ]
+
+            for index, (valid, eta_fit, var_lss_fit, fudge_fit, chi2,
+                        num_pixels_fit) in enumerate(fit_results):
+                if valid:
+                    eta[index] = eta_fit
+                    var_lss[index] = var_lss_fit
+                    fudge[index] = fudge_fit
                     valid_fit[index] = True
                 else:
                     eta[index] = ETA_DEFAULT
                     var_lss[index] = VAR_LSS_DEFAULT
                     fudge[index] = FUDGE_DEFAULT
                     valid_fit[index] = False
-                num_pixels[index] = leasts_squares.get_num_pixels()
-                chi2_in_bin[index] = minimizer.fval
+                num_pixels[index] = num_pixels_fit
+                chi2_in_bin[index] = chi2
 
                 self.logger.progress(
                     f" {self.log_lambda_var_func_grid[index]:.3e} "
@@ -627,30 +744,19 @@ class Dr16ExpectedFlux(ExpectedFlux):
         The open fits file
         """
         if self.continuum_fit_parameters is not None:
-            los_id_list = []
-            zero_point_list = []
-            slope_list = []
-            chi2_list = []
-            ndata_list = []
-            accepted_fit = []
-            for los_id in sorted(self.continuum_fit_parameters):
-                cont_fit = self.continuum_fit_parameters.get(los_id)
-                los_id_list.append(los_id)
-                zero_point_list.append(cont_fit[0])
-                slope_list.append(cont_fit[1])
-                chi2_list.append(cont_fit[2])
-                ndata_list.append(cont_fit[3])
-                if any(np.isnan(cont_fit)):
-                    accepted_fit.append(False)
-                else:
-                    accepted_fit.append(True)
+            # write one row per line of sight, sorted by los_id. If several
+            # forests share a los_id, the last one is kept
+            los_ids, last_index = np.unique(
+                self.continuum_fit_los_ids[::-1], return_index=True)
+            cont_fit = self.continuum_fit_parameters[
+                self.continuum_fit_los_ids.size - 1 - last_index]
             values = [
-                np.array(los_id_list),
-                np.array(zero_point_list),
-                np.array(slope_list),
-                np.array(chi2_list),
-                np.array(ndata_list, dtype=int),
-                np.array(accepted_fit),
+                los_ids,
+                cont_fit[:, 0],
+                cont_fit[:, 1],
+                cont_fit[:, 2],
+                np.nan_to_num(cont_fit[:, 3], nan=0).astype(int),
+                ~np.isnan(cont_fit).any(axis=1),
             ]
             names = [
                 "LOS_ID",
@@ -713,7 +819,7 @@ class Dr16ExpectedFlux(ExpectedFlux):
             # forest.continuum gets modified within if statement
             mean_expected_flux = np.copy(forest.continuum)
             if self.force_stack_delta_to_zero:
-                stack_delta = self.get_stack_delta(forest.log_lambda)
+                stack_delta = self.get_stack_delta_grid()[forest.log_lambda_bins]
                 mean_expected_flux *= stack_delta
 
             weights = self.compute_forest_weights(forest, mean_expected_flux)
@@ -724,7 +830,8 @@ class Dr16ExpectedFlux(ExpectedFlux):
                 "continuum": forest.continuum,
             }
             if isinstance(forest, Pk1dForest):
-                eta = self.get_eta(forest.log_lambda)
+                eta = self.get_variance_functions_grid()[0][
+                    forest.log_lambda_bins]
                 ivar = forest.ivar / (eta +
                                       (eta == 0)) * (mean_expected_flux**2)
 
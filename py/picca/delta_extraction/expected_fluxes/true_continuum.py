@@ -11,8 +11,9 @@ from pkg_resources import resource_filename
 from picca.delta_extraction.astronomical_objects.forest import Forest
 from picca.delta_extraction.astronomical_objects.pk1d_forest import Pk1dForest
 from picca.delta_extraction.errors import ExpectedFluxError
-from picca.delta_extraction.expected_flux import ExpectedFlux, defaults, accepted_options
-from picca.delta_extraction.utils import (update_accepted_options,
+from picca.delta_extraction.expected_flux import (
+    ExpectedFlux, defaults, accepted_options, STACK_CHUNK_SIZE)
+from picca.delta_extraction.utils import (stack_pixels, update_accepted_options,
                                           update_default_options)
 
 accepted_options = update_accepted_options(accepted_options, [
@@ -31,6 +32,46 @@ defaults = update_default_options(defaults, {
 
 IN_NSIDE = 16
 
+# objects shared with the worker processes reading the true continua
+# (see TrueContinuum.read_all_true_continua)
+_worker_expected_flux = None # pylint: disable=invalid-name
+_worker_forests_n_healpix = None # pylint: disable=invalid-name
+
+
+def _init_true_continuum_worker(expected_flux, forests_n_healpix):
+    """Store the objects shared with a worker process reading the true
+    continua. Workers are forked, so the objects are inherited without
+    being pickled
+
+    Arguments
+    ---------
+    expected_flux: TrueContinuum
+    The instance reading the true continua
+
+    forests_n_healpix: list of (list of Forest, int)
+    The forests grouped by healpix, and the healpix number of each group
+    """
+    global _worker_expected_flux, _worker_forests_n_healpix # pylint: disable=global-statement,invalid-name
+    _worker_expected_flux = expected_flux
+    _worker_forests_n_healpix = forests_n_healpix
+
+
+def _compute_true_continua_worker(group_index):
+    """Compute the true continua of one group of forests in a worker process
+
+    Arguments
+    ---------
+    group_index: int
+    Index of the group in the list passed to _init_true_continuum_worker
+
+    Return
+    ------
+    continua: List of array of float
+    The continuum of each forest in the group
+    """
+    forests, healpix = _worker_forests_n_healpix[group_index]
+    return _worker_expected_flux.compute_true_continua(forests, healpix)
+
 
 class TrueContinuum(ExpectedFlux):
     """Class to compute the expected flux using the true unabsorbed contiuum
@@ -44,7 +85,11 @@ class TrueContinuum(ExpectedFlux):
     __init__
     __parse_config
     compute_expected_flux
+    compute_forest_weights
     compute_mean_cont
+    compute_true_continua
+    get_mean_flux_grid
+    get_var_lss_grid
     populate_los_ids
     read_true_continuum
     read_raw_statistics
@@ -54,10 +99,10 @@ class TrueContinuum(ExpectedFlux):
     ----------
     (see ExpectedFlux in py/picca/delta_extraction/expected_flux.py)
 
-    get_mean_cont: scipy.interpolate.interp1d
+    get_mean_cont: LinearInterpolator
     Interpolation function to compute the unabsorbed mean quasar continua.
 
-    get_mean_cont_weight: scipy.interpolate.interp1d
+    get_mean_cont_weight: LinearInterpolator
     Interpolation function to compute the weights associated with the unabsorbed
     mean quasar continua.
 
@@ -71,7 +116,7 @@ class TrueContinuum(ExpectedFlux):
     iter_out_prefix: str
     Prefix of the iteration files. These file contain the statistical properties
     of deltas at a given iteration step. Intermediate files will add
-    '_iteration{num}.fits.gz' to the prefix for intermediate steps and '.fits.gz'
+    '_iteration{num}.fits' to the prefix for intermediate steps and '.fits.gz'
     for the final results.
 
     num_bins_variance: int
@@ -102,6 +147,14 @@ class TrueContinuum(ExpectedFlux):
         self.get_var_lss = None
         self.get_mean_flux = None
         self.read_raw_statistics()
+        # values of get_var_lss in Forest.log_lambda_grid
+        # (see method get_var_lss_grid)
+        self._var_lss_grid = None
+        # values of get_mean_flux in Forest.log_lambda_grid
+        # (see method get_mean_flux_grid)
+        self._mean_flux_grid = None
+        # weights of each line of sight (see method compute_forest_weights)
+        self._forest_weights = {}
 
     def __parse_config(self, config):
         """Parse the configuration options
@@ -163,6 +216,9 @@ class TrueContinuum(ExpectedFlux):
         -----
         ExpectedFluxError if Forest.wave_solution is not 'lin' or 'log'
         """
+        # the cached weights only live while the forests are processed
+        self._forest_weights = {}
+
         forests = self.read_all_true_continua(forests)
 
         # the might be some small changes in the var_lss compared to the read
@@ -186,6 +242,9 @@ class TrueContinuum(ExpectedFlux):
         # now loop over forests to populate los_ids
         self.populate_los_ids(forests)
 
+        # release the references to the forest arrays
+        self._forest_weights = {}
+
     def compute_mean_cont(self, forests):
         """Compute the mean quasar continuum over the whole sample.
         Then updates the value of self.get_mean_cont to contain it
@@ -199,7 +258,14 @@ class TrueContinuum(ExpectedFlux):
         return super()._compute_mean_cont(forests)
 
     def compute_forest_weights(self, forest, continuum):
-        """Compute the forest variance
+        """Compute the forest weights
+
+        The true continua do not change once they are read, so the weights
+        are cached for each line of sight and shared by compute_mean_cont,
+        compute_delta_stack and populate_los_ids. The cache is refreshed
+        whenever the forest ivar, the continuum or get_var_lss are replaced,
+        and it is emptied at the start and at the end of
+        compute_expected_flux.
 
         Arguments
         ---------
@@ -208,7 +274,19 @@ class TrueContinuum(ExpectedFlux):
 
         continuum: array of float
         Quasar continuum associated with the forest
+
+        Return
+        ------
+        weights: array of float
+        The forest weights
         """
+        cache_key = (forest.ivar, continuum, self.get_var_lss)
+        cached_weights = self._forest_weights.get(forest.los_id)
+        if cached_weights is not None and all(
+                item is cached_item
+                for item, cached_item in zip(cache_key, cached_weights[0])):
+            return cached_weights[1]
+
         w = forest.ivar > 0
         weights = np.empty_like(forest.log_lambda)
         weights[~w] = 0.0
@@ -216,12 +294,51 @@ class TrueContinuum(ExpectedFlux):
         if self.use_constant_weight:
             weights[w] = 1
         else:
-            var_lss = self.get_var_lss(forest.log_lambda[w])
-            ivar_pipe = forest.ivar * forest.continuum**2
-            weights[w] = 1.0/(self.var_lss_mod * var_lss + 1/ivar_pipe[w])
+            var_lss = self.get_var_lss_grid()[forest.log_lambda_bins[w]]
+            var_pipe = 1. / forest.ivar[w] / continuum[w]**2
+            weights[w] = 1.0/(self.var_lss_mod * var_lss + var_pipe)
 
+        self._forest_weights[forest.los_id] = (cache_key, weights)
         return weights
 
+    def get_mean_flux_grid(self):
+        """Get the values of get_mean_flux in Forest.log_lambda_grid
+
+        Values are computed once and cached. The cache is refreshed whenever
+        get_mean_flux or the grid are replaced.
+
+        Return
+        ------
+        mean_flux: array of float
+        Values of get_mean_flux in Forest.log_lambda_grid
+        """
+        cache_key = (self.get_mean_flux, Forest.log_lambda_grid)
+        if (self._mean_flux_grid is None or any(
+                item is not cached_item for item, cached_item in zip(
+                    cache_key, self._mean_flux_grid[0]))):
+            self._mean_flux_grid = (cache_key,
+                                    self.get_mean_flux(Forest.log_lambda_grid))
+        return self._mean_flux_grid[1]
+
+    def get_var_lss_grid(self):
+        """Get the values of var_lss in Forest.log_lambda_grid
+
+        Values are computed once and cached. The cache is refreshed whenever
+        get_var_lss or the grid are replaced.
+
+        Return
+        ------
+        var_lss: array of float
+        Values of get_var_lss in Forest.log_lambda_grid
+        """
+        cache_key = (self.get_var_lss, Forest.log_lambda_grid)
+        if (self._var_lss_grid is None or any(
+                item is not cached_item for item, cached_item in zip(
+                    cache_key, self._var_lss_grid[0]))):
+            self._var_lss_grid = (cache_key,
+                                  self.get_var_lss(Forest.log_lambda_grid))
+        return self._var_lss_grid[1]
+
     def hdu_var_func(self, results):
         """Add to the results file an HDU with the variance functions
 
@@ -257,19 +374,12 @@ class TrueContinuum(ExpectedFlux):
             if forest.bad_continuum_reason is not None:
                 continue
 
-            # get the variance functions
-            if self.use_constant_weight:
-                w = forest.ivar>0
-                weights = np.empty_like(forest.log_lambda)
-                weights[w] = 1
-                weights[~w] = 0
-            else:
-                weights = self.compute_forest_weights(
-                    forest, forest.continuum)
+            # the weights were already computed when stacking
+            weights = self.compute_forest_weights(forest, forest.continuum)
 
             mean_expected_flux = np.copy(forest.continuum)
             if self.force_stack_delta_to_zero:
-                stack_delta = self.get_stack_delta(forest.log_lambda)
+                stack_delta = self.get_stack_delta_grid()[forest.log_lambda_bins]
                 mean_expected_flux *= stack_delta
 
             forest_info = {
@@ -295,28 +405,46 @@ class TrueContinuum(ExpectedFlux):
         -----
         ExpectedFluxError if Forest.wave_solution is not 'lin' or 'log'
         """
-        healpixes = np.array([healpy.ang2pix(IN_NSIDE,
-                                 np.pi / 2 - forest.dec,
-                                 forest.ra,
-                                 nest=True)
-                              for forest in forests], dtype=int)
+        ra = np.array([forest.ra for forest in forests])
+        dec = np.array([forest.dec for forest in forests])
+        healpixes = healpy.ang2pix(IN_NSIDE, np.pi / 2 - dec, ra,
+                                   nest=True).astype(int)
 
-        unique_healpixes = np.unique(healpixes)
         # healpix_n_forests is a list of (sublist, healpix),
-        # where each sublist corresponds to a healpix
-        forests_n_healpix = []
-        for healpix in unique_healpixes:
-            this_idx = np.nonzero(healpix == healpixes)[0]
-            forests_n_healpix.append(([forests[i] for i in this_idx], healpix))
+        # where each sublist corresponds to a healpix. Forests are grouped
+        # with a single stable sort to keep their original order within
+        # each healpix
+        unique_healpixes, healpix_index = np.unique(healpixes,
+                                                    return_inverse=True)
+        sort_index = np.argsort(healpix_index, kind="stable")
+        group_ends = np.cumsum(np.bincount(healpix_index))[:-1]
+        forests_n_healpix = [
+            ([forests[i] for i in this_idx], healpix) for this_idx, healpix in
+            zip(np.split(sort_index, group_ends), unique_healpixes)
+        ]
 
         self.logger.progress(
             f"Reading continum with {self.num_processors} processors")
 
         if self.num_processors > 1:
+            # forked workers inherit the forests through the pool initializer,
+            # so only the group index is sent to them and only the continua
+            # are sent back
             context = multiprocessing.get_context('fork')
-            with context.Pool(processes=self.num_processors) as pool:
-                grouped_forests = pool.starmap(self.read_true_continuum_one_healpix,
-                    forests_n_healpix)
+            with context.Pool(processes=self.num_processors,
+                              initializer=_init_true_continuum_worker,
+                              initargs=(self, forests_n_healpix)) as pool:
+                # healpix groups have very different sizes, so they are
+                # handed out one at a time to balance the load
+                grouped_continua = pool.map(_compute_true_continua_worker,
+                                            range(len(forests_n_healpix)),
+                                            chunksize=1)
+            grouped_forests = []
+            for (subforests, _), continua in zip(forests_n_healpix,
+                                                 grouped_continua):
+                for forest, continuum in zip(subforests, continua):
+                    forest.continuum = continuum
+                grouped_forests.append(subforests)
         else:
             grouped_forests = []
             for subforests, healpix in forests_n_healpix:
@@ -348,6 +476,33 @@ class TrueContinuum(ExpectedFlux):
         -----
         ExpectedFluxError if Forest.wave_solution is not 'lin' or 'log'
         """
+        continua = self.compute_true_continua(forests, healpix)
+        for forest, continuum in zip(forests, continua):
+            forest.continuum = continuum
+
+        return forests
+
+    def compute_true_continua(self, forests, healpix=None):
+        """Compute the continua of the forests in one healpix from the truth
+        file, without modifying the forests
+
+        Arguments
+        ---------
+        forests: List of Forest
+        A list of forest instances where the continuum will be computed
+
+        healpix: int (Optional)
+        Healpix number that forests belong to
+
+        Return
+        ------
+        continua: List of array of float
+        The continuum of each forest
+
+        Raise
+        -----
+        ExpectedFluxError if a forest is not found in the truth file
+        """
         if healpix is None:
             healpix = healpy.ang2pix(IN_NSIDE,
                                      np.pi / 2 - forests[0].dec,
@@ -357,29 +512,57 @@ class TrueContinuum(ExpectedFlux):
         filename_truth = (
             f"{self.input_directory}/{healpix//100}/{healpix}/truth-{IN_NSIDE}-"
             f"{healpix}.fits")
-        hdul = fitsio.FITS(filename_truth)
-        header = hdul["TRUE_CONT"].read_header()
+        with fitsio.FITS(filename_truth) as hdul:
+            header = hdul["TRUE_CONT"].read_header()
+            # map each target id to its first row in the truth file
+            targetids, first_rows = np.unique(
+                hdul["TRUE_CONT"].read_column("TARGETID"), return_index=True)
+            targetid_rows = dict(zip(targetids.tolist(), first_rows.tolist()))
+            rows = []
+            for forest in forests:
+                indx = targetid_rows.get(forest.targetid)
+                if indx is None:
+                    raise ExpectedFluxError("Forest target id was not found "
+                                            "in the truth file.")
+                rows.append(indx)
+            # only the true continua of the forests in the batch are read
+            rows_needed, forest_rows = np.unique(rows, return_inverse=True)
+            true_continuum = hdul["TRUE_CONT"].read(columns=["TRUE_CONT"],
+                                                    rows=rows_needed)["TRUE_CONT"]
         lambda_min = header["WMIN"]
         lambda_max = header["WMAX"]
         delta_lambda = header["DWAVE"]
         lambda_ = np.arange(lambda_min, lambda_max + delta_lambda, delta_lambda)
-        true_cont = hdul["TRUE_CONT"].read()
-        for forest in forests:
-            indx = np.nonzero(true_cont["TARGETID"] == forest.targetid)[0]
-            if indx.size == 0:
-                raise ExpectedFluxError("Forest target id was not found in "
-                                        "the truth file.")
-            indx = indx[0]
-
-            # Should we also check for healpix consistency here?
-            true_continuum = interp1d(lambda_, true_cont["TRUE_CONT"][indx])
-
-            forest.continuum = true_continuum(10**forest.log_lambda)
-            forest.continuum *= self.get_mean_flux(forest.log_lambda)
-            forest.continuum *= forest.transmission_correction
-
-        hdul.close()
-        return forests
+        # forest pixels lie on Forest.log_lambda_grid, so the wavelength and
+        # the mean flux are computed once in the grid and then looked up
+        lambda_grid = 10**Forest.log_lambda_grid
+        mean_flux_grid = self.get_mean_flux_grid()
+        # the true continua are sampled in a uniform wavelength grid, so the
+        # positions for the linear interpolation are also computed once
+        position = (lambda_grid - lambda_min) / delta_lambda
+        index_grid = np.clip(np.floor(position).astype(np.int64), 0,
+                             lambda_.size - 2)
+        fraction_grid = position - index_grid
+        in_range_grid = (lambda_grid >= lambda_[0]) & (lambda_grid <= lambda_[-1])
+
+        # Should we also check for healpix consistency here?
+        # the pixels of all the forests are interpolated together, and the
+        # result is then split back into the individual continua
+        sizes = [forest.log_lambda_bins.size for forest in forests]
+        bins = np.concatenate([forest.log_lambda_bins for forest in forests])
+        if not np.all(in_range_grid[bins]):
+            raise ExpectedFluxError("Forest wavelength is outside the "
+                                    "range of the truth file.")
+        pixel_rows = np.repeat(forest_rows, sizes)
+        index = index_grid[bins]
+        true_continuum_left = true_continuum[pixel_rows, index]
+        continuum = true_continuum_left + fraction_grid[bins] * (
+            true_continuum[pixel_rows, index + 1] - true_continuum_left)
+        continuum *= mean_flux_grid[bins]
+        continuum *= np.concatenate(
+            [forest.transmission_correction for forest in forests])
+
+        return np.split(continuum, np.cumsum(sizes)[:-1])
 
     def read_raw_statistics(self):
         """Read the LSS delta variance and mean transmitted flux from files
@@ -521,15 +704,23 @@ class TrueContinuum(ExpectedFlux):
         var_lss = np.zeros_like(Forest.log_lambda_grid)
         counts = np.zeros_like(Forest.log_lambda_grid)
 
-        for forest in forests:
-            w = forest.ivar > 0
-            log_lambda_bins = Forest.find_bins( # pylint: disable=not-callable
-                forest.log_lambda,
-                Forest.log_lambda_grid)[w]
-            var_pipe = 1. / forest.ivar[w] / forest.continuum[w]**2
-            deltas = forest.flux[w] / forest.continuum[w] - 1
-            var_lss[log_lambda_bins] += deltas**2 - var_pipe
-            counts[log_lambda_bins] += 1
+        # as in compute_delta_stack, forests are added in chunks. Each pixel
+        # is added with unit weight, so counts holds the number of pixels
+        for start in range(0, len(forests), STACK_CHUNK_SIZE):
+            bins = []
+            values = []
+            for forest in forests[start:start + STACK_CHUNK_SIZE]:
+                w = forest.ivar > 0
+                var_pipe = 1. / forest.ivar[w] / forest.continuum[w]**2
+                deltas = forest.flux[w] / forest.continuum[w] - 1
+                bins.append(forest.log_lambda_bins[w])
+                values.append(deltas**2 - var_pipe)
+
+            if len(bins) == 0:
+                continue
+            bins = np.concatenate(bins)
+            stack_pixels(bins, np.concatenate(values), np.ones(bins.size),
+                         var_lss, counts)
 
         w = counts > 0
         var_lss[w] /= counts[w]
@@ -1,9 +1,15 @@
-"""This module defines the method compute_continuum to compute the quasar continua"""
+"""This module defines the method compute_continuum to compute the quasar continua,
+the method compute_var_func_bin to fit the variance functions, and the method
+compute_weights to compute the weights given the variance functions"""
 import iminuit
+from numba import njit
 import numpy as np
+from scipy.optimize import least_squares
 
 from picca.delta_extraction.astronomical_objects.forest import Forest
 from picca.delta_extraction.least_squares.least_squares_cont_model import LeastsSquaresContModel
+from picca.delta_extraction.least_squares.least_squares_var_stats import FUDGE_REF
+from picca.delta_extraction.utils import LinearInterpolator
 
 
 def compute_continuum(forest, get_mean_cont, get_eta, get_var_lss, get_fudge,
@@ -19,7 +25,7 @@ def compute_continuum(forest, get_mean_cont, get_eta, get_var_lss, get_fudge,
     forest: Forest
     A forest instance where the continuum will be computed
 
-    get_mean_cont: scipy.interpolate.interp1d
+    get_mean_cont: LinearInterpolator
     Interpolation function to compute the unabsorbed mean quasar continua.
 
     get_eta: scipy.interpolate.interp1d
@@ -54,7 +60,14 @@ def compute_continuum(forest, get_mean_cont, get_eta, get_var_lss, get_fudge,
     the chi2 of the fit, and the number of datapoints used in the fit.
     """
     # get mean continuum
-    mean_cont = get_mean_cont(forest.log_lambda - np.log10(1 + forest.z))
+    # if it is sampled in the rest-frame grid, use the cached interpolation
+    # positions
+    if (isinstance(get_mean_cont, LinearInterpolator) and
+            get_mean_cont.has_nodes(Forest.log_lambda_rest_frame_grid)):
+        mean_cont = get_mean_cont.interpolate_from_positions(
+            *forest.log_lambda_rest_frame_interp)
+    else:
+        mean_cont = get_mean_cont(forest.log_lambda - np.log10(1 + forest.z))
 
     # add transmission correction
     # (previously computed using method add_optical_depth)
@@ -78,9 +91,10 @@ def compute_continuum(forest, get_mean_cont, get_eta, get_var_lss, get_fudge,
 
     leasts_squares = LeastsSquaresContModel(forest=forest,
                                             mean_cont_kwargs=mean_cont_kwargs,
-                                            weights_kwargs=weights_kwargs)
+                                            weights_kwargs=weights_kwargs,
+                                            order=order)
 
-    zero_point = (forest.flux * forest.ivar).sum() / forest.ivar.sum()
+    zero_point = np.dot(forest.flux, forest.ivar) / forest.ivar.sum()
     slope = 0.0
 
     minimizer = iminuit.Minuit(leasts_squares,
@@ -117,3 +131,229 @@ def compute_continuum(forest, get_mean_cont, get_eta, get_var_lss, get_fudge,
                                     leasts_squares.get_ndata())
 
     return cont_model, bad_continuum_reason, continuum_fit_parameters
+
+
+def compute_var_func_bin(leasts_squares, index, eta, var_lss, fudge, limit_eta,
+                         limit_var_lss, fit_variance_functions,
+                         variance_fitter="iminuit"):
+    """Fit the variance functions in one bin of the variance wavelength grid.
+
+    Bins are fitted independently, which allows to run the fits in parallel.
+
+    Arguments
+    ---------
+    leasts_squares: LeastsSquaresVarStats
+    The fitter class, initialized with the statistics of the deltas
+
+    index: int
+    Index of the bin in the variance wavelength grid
+
+    eta: float
+    Starting value of the mapping function eta
+
+    var_lss: float
+    Starting value of the mapping function var_lss
+
+    fudge: float
+    Starting value of the mapping function fudge
+
+    limit_eta: tuple of floats
+    Limits on eta
+
+    limit_var_lss: tuple of floats
+    Limits on var_lss
+
+    fit_variance_functions: list of str
+    Names of the mapping functions to fit. The remaining ones are fixed to
+    their starting values.
+
+    variance_fitter: str - default: "iminuit"
+    Minimizer to use. Either "iminuit" (migrad) or "scipy"
+    (scipy.optimize.least_squares)
+
+    Return
+    ------
+    valid_fit: bool
+    True if the fit converged, False otherwise
+
+    eta: float
+    Best-fit value of eta
+
+    var_lss: float
+    Best-fit value of var_lss
+
+    fudge: float
+    Best-fit value of fudge
+
+    chi2: float
+    The chi2 of the fit
+
+    num_pixels: int
+    Number of pixels participating in the fit
+    """
+    leasts_squares.set_fit_bins(index)
+
+    if variance_fitter == "scipy":
+        return fit_var_func_bin_scipy(leasts_squares, eta, var_lss, fudge,
+                                      limit_eta, limit_var_lss,
+                                      fit_variance_functions)
+
+    minimizer = iminuit.Minuit(leasts_squares,
+                               name=("eta", "var_lss", "fudge"),
+                               grad=leasts_squares.get_gradient,
+                               eta=eta,
+                               var_lss=var_lss,
+                               fudge=fudge / FUDGE_REF)
+    minimizer.errors["eta"] = 0.05
+    minimizer.limits["eta"] = limit_eta
+    minimizer.errors["var_lss"] = 0.05
+    minimizer.limits["var_lss"] = limit_var_lss
+    minimizer.errors["fudge"] = 0.05
+    minimizer.limits["fudge"] = (0, None)
+    minimizer.errordef = 1.
+    minimizer.print_level = 0
+    minimizer.fixed["eta"] = "eta" not in fit_variance_functions
+    minimizer.fixed["var_lss"] = "var_lss" not in fit_variance_functions
+    minimizer.fixed["fudge"] = "fudge" not in fit_variance_functions
+    # parameter errors are not used, so hesse is not run after migrad
+    minimizer.migrad()
+
+    return (minimizer.valid, minimizer.values["eta"],
+            minimizer.values["var_lss"], minimizer.values["fudge"] * FUDGE_REF,
+            minimizer.fval, leasts_squares.get_num_pixels())
+
+
+def fit_var_func_bin_scipy(leasts_squares, eta, var_lss, fudge, limit_eta,
+                           limit_var_lss, fit_variance_functions):
+    """Fit the variance functions in the selected bin using
+    scipy.optimize.least_squares (Trust Region Reflective algorithm).
+
+    Fixed functions are kept out of the minimization.
+
+    Arguments
+    ---------
+    leasts_squares: LeastsSquaresVarStats
+    The fitter class, with the fit bins already set
+
+    eta: float
+    Starting value of the mapping function eta
+
+    var_lss: float
+    Starting value of the mapping function var_lss
+
+    fudge: float
+    Starting value of the mapping function fudge
+
+    limit_eta: tuple of floats
+    Limits on eta
+
+    limit_var_lss: tuple of floats
+    Limits on var_lss
+
+    fit_variance_functions: list of str
+    Names of the mapping functions to fit. The remaining ones are fixed to
+    their starting values.
+
+    Return
+    ------
+    valid_fit: bool
+    True if the fit converged, False otherwise
+
+    eta: float
+    Best-fit value of eta
+
+    var_lss: float
+    Best-fit value of var_lss
+
+    fudge: float
+    Best-fit value of fudge
+
+    chi2: float
+    The chi2 of the fit
+
+    num_pixels: int
+    Number of pixels participating in the fit
+    """
+    # fudge is fitted in units of FUDGE_REF, as in the iminuit fit
+    names = ("eta", "var_lss", "fudge")
+    params = np.array([eta, var_lss, fudge / FUDGE_REF])
+    lower_limits = np.array([limit_eta[0], limit_var_lss[0], 0.])
+    upper_limits = np.array([limit_eta[1], limit_var_lss[1], np.inf])
+    free = np.array([name in fit_variance_functions for name in names])
+
+    def get_residuals(free_params):
+        """Compute the residuals given the values of the free parameters"""
+        all_params = params.copy()
+        all_params[free] = free_params
+        return leasts_squares.get_residuals(*all_params)
+
+    def get_residuals_jacobian(free_params):
+        """Compute the derivatives of the residuals with respect to the free
+        parameters"""
+        all_params = params.copy()
+        all_params[free] = free_params
+        return leasts_squares.get_residuals_jacobian(*all_params)[:, free]
+
+    # there is nothing to fit if no variance bin has enough quasars
+    if get_residuals(params[free]).size == 0:
+        return (False, eta, var_lss, fudge, 0.0,
+                leasts_squares.get_num_pixels())
+
+    result = least_squares(get_residuals,
+                           np.clip(params[free], lower_limits[free],
+                                   upper_limits[free]),
+                           jac=get_residuals_jacobian,
+                           bounds=(lower_limits[free], upper_limits[free]),
+                           method="trf",
+                           xtol=1e-5)
+    params[free] = result.x
+
+    return (result.success, params[0], params[1], params[2] * FUDGE_REF,
+            2 * result.cost, leasts_squares.get_num_pixels())
+
+
+@njit()
+def compute_weights(bins, ivar, continuum, eta, var_lss, fudge, var_lss_mod):
+    """Compute the forest weights following du Mas des Bourboux 2020
+
+    The pipeline variance, the variance and the weights are computed in a
+    single pass over the pixels. Pixels with ivar = 0 get zero weight.
+
+    Arguments
+    ---------
+    bins: array of int
+    Bins of the forest pixels in the grid where the variance functions are
+    given (e.g. Forest.log_lambda_bins)
+
+    ivar: array of float
+    Inverse variance of the forest pixels
+
+    continuum: array of float
+    Quasar continuum associated with the forest
+
+    eta: array of float
+    Values of the mapping function eta in the grid
+
+    var_lss: array of float
+    Values of the mapping function var_lss in the grid
+
+    fudge: array of float
+    Values of the mapping function fudge in the grid
+
+    var_lss_mod: float
+    Factor multiplying var_lss
+
+    Return
+    ------
+    weights: array of float
+    The forest weights
+    """
+    weights = np.zeros(ivar.size)
+    for index in range(ivar.size):
+        if ivar[index] > 0:
+            var_pipe = 1. / ivar[index] / continuum[index]**2
+            grid_bin = bins[index]
+            weights[index] = 1.0 / (eta[grid_bin] * var_pipe +
+                                    var_lss_mod * var_lss[grid_bin] +
+                                    fudge[grid_bin] / var_pipe)
+    return weights
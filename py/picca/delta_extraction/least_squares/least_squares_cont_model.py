@@ -1,8 +1,80 @@
 """This module defines the class LeastsSquaresContModel"""
+from numba import njit
 import numpy as np
 
 from picca.delta_extraction.errors import LeastSquaresError
 
+@njit()
+def continuum_model_order0(zero_point, slope, log_lambda, log_lambda_min,
+                           log_lambda_max, mean_cont):
+    # pylint: disable=unused-argument
+    """Compute the continuum model for a polynomial of order 0
+
+    The slope is ignored and the model reduces to zero_point * mean_cont.
+    Arguments are the same as in continuum_model_order1 so that both
+    functions can be used interchangeably.
+
+    Arguments
+    ---------
+    zero_point: float
+    Zero point of the linear function (flux mean)
+
+    slope: float
+    Ignored
+
+    log_lambda: array of float
+    Ignored
+
+    log_lambda_min: float
+    Ignored
+
+    log_lambda_max: float
+    Ignored
+
+    mean_cont: array of float
+    Mean continuum
+
+    Return
+    ------
+    cont_model: array of float
+    The continuum model
+    """
+    return zero_point * mean_cont
+
+@njit()
+def continuum_model_order1(zero_point, slope, log_lambda, log_lambda_min,
+                           log_lambda_max, mean_cont):
+    """Compute the continuum model for a polynomial of order 1
+
+    Arguments
+    ---------
+    zero_point: float
+    Zero point of the linear function (flux mean)
+
+    slope: float
+    Slope of the linear function (evolution of the flux)
+
+    log_lambda: array of float
+    Logarithm of the wavelength (in Angstroms)
+
+    log_lambda_min: float
+    Minimum log_lambda for this forest.
+
+    log_lambda_max: float
+    Maximum log_lambda for this forest.
+
+    mean_cont: array of float
+    Mean continuum
+
+    Return
+    ------
+    cont_model: array of float
+    The continuum model
+    """
+    line = (slope * (log_lambda - log_lambda_min) /
+            (log_lambda_max - log_lambda_min) + zero_point)
+    return line * mean_cont
+
 
 class LeastsSquaresContModel:
     """This class deals with the continuum fitting.
@@ -18,6 +90,11 @@ class LeastsSquaresContModel:
 
     Attributes
     ----------
+    continuum_model: function
+    Function used to compute the continuum model. It is specialized on the
+    order of the polynomial (see continuum_model_order0 and
+    continuum_model_order1)
+
     forest: Forest
     Forest instance where the model is fit
 
@@ -34,7 +111,8 @@ class LeastsSquaresContModel:
     def __init__(self,
                  forest,
                  mean_cont_kwargs=None,
-                 weights_kwargs=None):
+                 weights_kwargs=None,
+                 order=1):
         """Initialize class instances
 
         Arguments
@@ -49,6 +127,10 @@ class LeastsSquaresContModel:
         weights_kwargs: dict or None - default = None
         kwargs needed by method get_continuum_weights. If None
         then it will be assigned an empty dictionary
+
+        order: int - default = 1
+        Order of the polynomial for the continuum fit. For order 0 the slope
+        is ignored when computing the continuum model
         """
         self.forest = forest
         if mean_cont_kwargs is None:
@@ -60,6 +142,11 @@ class LeastsSquaresContModel:
         else:
             self.weights_kwargs = weights_kwargs
 
+        if order == 0:
+            self.continuum_model = continuum_model_order0
+        else:
+            self.continuum_model = continuum_model_order1
+
         self.ndata = None
 
     def __call__(self, zero_point, slope):
@@ -88,11 +175,12 @@ class LeastsSquaresContModel:
             self.forest, cont_model, **self.weights_kwargs)
 
         w = weights > 0
-        chi2_contribution = (self.forest.flux - cont_model)**2 * weights
+        residuals = self.forest.flux - cont_model
+        residuals *= residuals
 
         if self.ndata is None:
             self.ndata =  self.forest.flux[w].size
-        return chi2_contribution.sum() - np.log(weights[w]).sum()
+        return np.dot(residuals, weights) - np.log(weights[w]).sum()
 
     def get_continuum_model(self, forest, zero_point, slope, **kwargs):
         """Get the model for the continuum fit
@@ -138,10 +226,8 @@ class LeastsSquaresContModel:
         log_lambda_max = kwargs.get("log_lambda_max")
         log_lambda_min = kwargs.get("log_lambda_min")
         # compute continuum
-        line = (slope * (forest.log_lambda - log_lambda_min) /
-                (log_lambda_max - log_lambda_min) + zero_point)
-
-        return line * mean_cont
+        return self.continuum_model(zero_point, slope, forest.log_lambda,
+                                    log_lambda_min, log_lambda_max, mean_cont)
 
     def get_continuum_weights(self, forest, cont_model, **kwargs):
         """Get the continuum model weights
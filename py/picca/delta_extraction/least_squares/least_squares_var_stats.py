@@ -21,7 +21,10 @@ class LeastsSquaresVarStats:
     __init__
     __call__
     initialize_delta_arrays
+    get_gradient
     get_num_pixels
+    get_residuals
+    get_residuals_jacobian
     set_fit_bins
 
     Attributes
@@ -145,6 +148,11 @@ class LeastsSquaresVarStats:
         num_pixels = np.zeros(self.num_bins_variance * NUM_VAR_BINS)
         num_qso = np.zeros(self.num_bins_variance * NUM_VAR_BINS)
 
+        # forest pixels are on Forest.log_lambda_grid, so their bins in
+        # log_lambda_var_func_grid are looked up from those of the grid
+        grid_var_func_bins = Forest.find_bins( # pylint: disable=not-callable
+            Forest.log_lambda_grid, self.log_lambda_var_func_grid)
+
         # compute delta statistics, binning the variance according to 'ivar'
         for forest in forests:
             # ignore forest if continuum could not be computed
@@ -165,9 +173,7 @@ class LeastsSquaresVarStats:
                 (VAR_PIPE_MAX - VAR_PIPE_MIN) * NUM_VAR_BINS).astype(int)
 
             # select the wavelength bins
-            log_lambda_bins = Forest.find_bins( # pylint: disable=not-callable
-                forest.log_lambda[w],
-                self.log_lambda_var_func_grid)
+            log_lambda_bins = grid_var_func_bins[forest.log_lambda_bins[w]]
 
             # compute overall bin
             bins = var_pipe_bins + NUM_VAR_BINS * log_lambda_bins
@@ -197,11 +203,98 @@ class LeastsSquaresVarStats:
         self.num_qso = num_qso
         self.num_pixels = num_pixels
 
+    def get_gradient(self, eta, var_lss, fudge):
+        """Compute the gradient of the chi2 (see method __call__) with respect
+        to eta, var_lss, and fudge
+
+        Arguments
+        ---------
+        eta: float
+        Correction factor to the contribution of the pipeline
+        estimate of the instrumental noise to the variance.
+
+        var_lss: float
+        Pixel variance due to the Large Scale Strucure
+
+        fudge: float
+        Fudge contribution to the pixel variance
+
+        Returns
+        -------
+        gradient: array of float
+        The derivatives of the chi2 with respect to eta, var_lss, and fudge
+        """
+        residuals = self.get_residuals(eta, var_lss, fudge)
+        return 2 * residuals.dot(
+            self.get_residuals_jacobian(eta, var_lss, fudge))
+
     def get_num_pixels(self):
         """Return the number of pixels participating in the fit"""
         return self.num_pixels[self.running_indexs[0]:self.
                                running_indexs[1]].sum()
 
+    def get_residuals(self, eta, var_lss, fudge):
+        """Compute the normalized residuals of the fit of eta, var_lss, and
+        fudge for a wavelength bin. The chi2 (see method __call__) is the sum
+        of their squares
+
+        Arguments
+        ---------
+        eta: float
+        Correction factor to the contribution of the pipeline
+        estimate of the instrumental noise to the variance.
+
+        var_lss: float
+        Pixel variance due to the Large Scale Strucure
+
+        fudge: float
+        Fudge contribution to the pixel variance
+
+        Returns
+        -------
+        residuals: array of float
+        The residuals for this run
+        """
+        variance = eta * self.var_pipe_values + var_lss + fudge * FUDGE_REF / self.var_pipe_values
+        residuals = (
+            self.var_delta[self.running_indexs[0]:self.running_indexs[1]] -
+            variance)
+        weights = self.var2_delta[self.running_indexs[0]:self.running_indexs[1]]
+        w = self.num_qso[self.running_indexs[0]:
+                         self.running_indexs[1]] > self.min_num_qso_in_fit
+        return residuals[w] / np.sqrt(weights[w])
+
+    def get_residuals_jacobian(self, eta, var_lss, fudge): # pylint: disable=unused-argument
+        """Compute the derivatives of the residuals (see method get_residuals)
+        with respect to eta, var_lss, and fudge. The model is linear in the
+        three parameters, so the derivatives do not depend on their values
+
+        Arguments
+        ---------
+        eta: float
+        Correction factor to the contribution of the pipeline
+        estimate of the instrumental noise to the variance.
+
+        var_lss: float
+        Pixel variance due to the Large Scale Strucure
+
+        fudge: float
+        Fudge contribution to the pixel variance
+
+        Returns
+        -------
+        jacobian: array of float
+        The derivatives of the residuals. Dimension is (num_residuals, 3)
+        """
+        weights = self.var2_delta[self.running_indexs[0]:self.running_indexs[1]]
+        w = self.num_qso[self.running_indexs[0]:
+                         self.running_indexs[1]] > self.min_num_qso_in_fit
+        sigma = np.sqrt(weights[w])
+        var_pipe_values = self.var_pipe_values[w]
+        return -np.stack([var_pipe_values / sigma,
+                          1. / sigma,
+                          FUDGE_REF / var_pipe_values / sigma], axis=1)
+
     def set_fit_bins(self, index):
         """Set the  selected bins for the fits
         (fits are wavelength-independent)
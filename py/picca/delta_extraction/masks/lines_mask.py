@@ -13,6 +13,36 @@ accepted_options = update_accepted_options(accepted_options, [
     "filename"
 ])
 
+def find_masked_pixels(log_lambda, log_wave_min, log_wave_max):
+    """Find the pixels falling inside any of a set of wavelength ranges
+
+    Arguments
+    ---------
+    log_lambda: array of float
+    Sorted logarithm of the wavelength of the pixels
+
+    log_wave_min: array of float
+    Logarithm of the lower limit of each range
+
+    log_wave_max: array of float
+    Logarithm of the upper limit of each range
+
+    Return
+    ------
+    masked: array of bool
+    True for the pixels inside at least one of the ranges
+    """
+    idx_min = np.searchsorted(log_lambda, log_wave_min)
+    idx_max = np.searchsorted(log_lambda, log_wave_max)
+    valid = idx_min < idx_max
+
+    # each range adds one at its first pixel and subtracts one after its last
+    # pixel, so the cumulative sum counts the ranges covering each pixel
+    coverage = np.cumsum(
+        np.bincount(idx_min[valid], minlength=log_lambda.size + 1) -
+        np.bincount(idx_max[valid], minlength=log_lambda.size + 1))
+    return coverage[:-1] > 0
+
 class LinesMask(Mask):
     """Class to mask (sky) lines
 
@@ -78,19 +108,14 @@ class LinesMask(Mask):
         CorrectionError if Forest.wave_solution is not 'lin' or 'log'
         """
         # find masking array
-        w = np.ones(forest.log_lambda.size, dtype=bool)
-        mask_idx_ranges = np.searchsorted(forest.log_lambda,
-            [self.mask_obs_frame['log_wave_min'],
-            self.mask_obs_frame['log_wave_max']]).T
-        for idx1, idx2 in mask_idx_ranges:
-            w[idx1:idx2] = 0
+        w = ~find_masked_pixels(forest.log_lambda,
+                                self.mask_obs_frame['log_wave_min'].data,
+                                self.mask_obs_frame['log_wave_max'].data)
 
         log_lambda_rest_frame = forest.log_lambda - np.log10(1.0 + forest.z)
-        mask_idx_ranges = np.searchsorted(log_lambda_rest_frame,
-            [self.mask_rest_frame['log_wave_min'],
-            self.mask_rest_frame['log_wave_max']]).T
-        for idx1, idx2 in mask_idx_ranges:
-            w[idx1:idx2] = 0
+        w &= ~find_masked_pixels(log_lambda_rest_frame,
+                                 self.mask_rest_frame['log_wave_min'].data,
+                                 self.mask_rest_frame['log_wave_max'].data)
 
         # do the actual masking
         for param in Forest.mask_fields:
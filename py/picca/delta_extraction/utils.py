@@ -187,6 +187,207 @@ def find_bins_log(original_array, grid_array):
     found_bin = ((original_array - grid_array[0]) / step + 0.5).astype(np.int64)
     return found_bin
 
+@njit()
+def stack_pixels(bins, values, weights, stack_values, stack_weights):
+    """Add the weighted values of a set of pixels to a stack
+
+    This is equivalent to adding np.bincount(bins, weights=values * weights)
+    to stack_values and np.bincount(bins, weights=weights) to stack_weights,
+    but it is done in a single pass and without temporary arrays.
+
+    Arguments
+    ---------
+    bins: array of int
+    Bins of the pixels in the stack
+
+    values: array of float
+    Values of the pixels
+
+    weights: array of float
+    Weights of the pixels
+
+    stack_values: array of float
+    Stack of the weighted values. Modified in place
+
+    stack_weights: array of float
+    Stack of the weights. Modified in place
+
+    Raise
+    -----
+    ValueError if any of the bins is outside the stack. In this case the
+    stacks are not modified
+    """
+    num_bins = min(stack_values.size, stack_weights.size)
+    for stack_bin in bins:
+        if stack_bin < 0 or stack_bin >= num_bins:
+            raise ValueError("Error stacking pixels. Found bins outside the "
+                             "stack")
+    for index, stack_bin in enumerate(bins):
+        stack_values[stack_bin] += values[index] * weights[index]
+        stack_weights[stack_bin] += weights[index]
+
+class LinearInterpolator:
+    """Linear interpolation of a 1D function based on np.interp
+
+    This is a lightweight replacement of scipy.interpolate.interp1d with
+    kind="linear". Values outside the range of x are either linearly
+    extrapolated from the edge segments or set to a fixed value.
+
+    Methods
+    -------
+    __init__
+    __call__
+    __getstate__
+    has_nodes
+    interpolate_from_positions
+
+    Attributes
+    ----------
+    extrapolate: bool
+    If True, values outside the range of x are linearly extrapolated
+
+    fill_value: float or None
+    Value returned outside the range of x when extrapolate is False.
+
+    slope_max: float
+    Slope of the last segment. Used for extrapolation.
+
+    slope_min: float
+    Slope of the first segment. Used for extrapolation.
+
+    x: array of float
+    Sorted x-coordinates of the data points
+
+    y: array of float
+    y-coordinates of the data points
+    """
+    def __init__(self, x, y, fill_value="extrapolate"):
+        """Initialize class instance
+
+        Arguments
+        ---------
+        x: array of float
+        Sorted x-coordinates of the data points
+
+        y: array of float
+        y-coordinates of the data points
+
+        fill_value: float or "extrapolate" - Default: "extrapolate"
+        If "extrapolate", values outside the range of x are linearly
+        extrapolated. Otherwise, they are set to this value.
+        """
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+
+        self.extrapolate = isinstance(fill_value, str) and fill_value == "extrapolate"
+        self.fill_value = None if self.extrapolate else float(fill_value)
+
+        if self.x.size > 1:
+            self.slope_min = (self.y[1] - self.y[0]) / (self.x[1] - self.x[0])
+            self.slope_max = (self.y[-1] - self.y[-2]) / (self.x[-1] - self.x[-2])
+        else:
+            self.slope_min = 0.0
+            self.slope_max = 0.0
+
+        # last nodes compared in has_nodes and the result of the comparison
+        self._compared_nodes = None
+        self._same_nodes = False
+
+    def __call__(self, x):
+        """Evaluate the interpolation
+
+        Arguments
+        ---------
+        x: float or array of float
+        Points where the function is evaluated
+
+        Return
+        ------
+        y: float or array of float
+        The interpolated values
+        """
+        if not self.extrapolate:
+            return np.interp(x, self.x, self.y,
+                             left=self.fill_value, right=self.fill_value)
+
+        x = np.asarray(x)
+        y = np.interp(x, self.x, self.y)
+        below = x < self.x[0]
+        if np.any(below):
+            y = np.where(below,
+                         self.y[0] + self.slope_min * (x - self.x[0]),
+                         y)
+        above = x > self.x[-1]
+        if np.any(above):
+            y = np.where(above,
+                         self.y[-1] + self.slope_max * (x - self.x[-1]),
+                         y)
+        return y
+
+    def __getstate__(self):
+        """Return the state to pickle
+
+        The result of the last node comparison is not pickled, as it refers
+        to an array of this process
+
+        Return
+        ------
+        state: dict
+        The instance attributes without the last node comparison
+        """
+        state = self.__dict__.copy()
+        state["_compared_nodes"] = None
+        state["_same_nodes"] = False
+        return state
+
+    def has_nodes(self, x):
+        """Check whether the interpolation nodes are the same as x
+
+        The comparison is only done once for a given array x: the result is
+        kept until has_nodes is called with a different array.
+
+        Arguments
+        ---------
+        x: array of float
+        The nodes to compare with
+
+        Return
+        ------
+        same_nodes: bool
+        True if the interpolation nodes are equal to x
+        """
+        if self.x is x:
+            return True
+        if self._compared_nodes is not x:
+            self._compared_nodes = x
+            self._same_nodes = (self.x.size == x.size and
+                                np.array_equal(self.x, x))
+        return self._same_nodes
+
+    def interpolate_from_positions(self, index, fraction):
+        """Evaluate the interpolation from precomputed positions
+
+        Positions are given in terms of the interpolation nodes and must be
+        computed with the same nodes (see method has_nodes). Values outside
+        the range of x are linearly extrapolated regardless of fill_value.
+
+        Arguments
+        ---------
+        index: array of int
+        Index of the node to the left of each point. Must be between 0 and
+        x.size - 2
+
+        fraction: array of float
+        Fractional position of each point between nodes index and index + 1
+
+        Return
+        ------
+        y: array of float
+        The interpolated values
+        """
+        y_left = self.y[index]
+        return y_left + fraction * (self.y[index + 1] - y_left)
+
 PROGRESS_LEVEL_NUM = 15
 logging.addLevelName(PROGRESS_LEVEL_NUM, "PROGRESS")
 
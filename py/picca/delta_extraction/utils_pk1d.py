@@ -18,6 +18,53 @@ from picca.delta_extraction.utils import SPEED_LIGHT
 # create logger
 module_logger = logging.getLogger(__name__)
 
+# conversion factor from SDSS wdisp (in pixels of 1e-4 in log10 lambda)
+# to km/s
+WDISP_TO_KMS = SPEED_LIGHT * 1.0e-4 * np.log(10.)
+
+
+@njit
+def _rebin_exposure(log_lambda, log_lambda_exp, flux_exp, ivar_exp, mask,
+                    flux_total, ivar_total):
+    """Add the ivar-weighted flux of one exposure to the coadd totals
+
+    Pixels flagged with mask bit 25 (COMBINEREJ) are skipped. As in the
+    original rebinning, the last bin reached by the exposure is discarded.
+
+    Arguments
+    ---------
+    log_lambda: array of floats
+    Logarithm of the wavelengths of the coadd (in Angs)
+
+    log_lambda_exp: array of floats
+    Logarithm of the wavelengths of the exposure (in Angs)
+
+    flux_exp: array of floats
+    Flux of the exposure
+
+    ivar_exp: array of floats
+    Inverse variance of the exposure
+
+    mask: array of ints
+    Pixel mask of the exposure
+
+    flux_total: array of floats
+    Sum of the ivar-weighted flux. Modified in place
+
+    ivar_total: array of floats
+    Sum of the ivar. Modified in place
+    """
+    if log_lambda_exp.size == 0:
+        return
+    log_lambda_bins = np.searchsorted(log_lambda, log_lambda_exp)
+    last_bin = log_lambda_bins.max()
+    for index, log_lambda_bin in enumerate(log_lambda_bins):
+        # exclude masks 25 (COMBINEREJ), 23 (BRIGHTSKY)?
+        if log_lambda_bin >= last_bin or (mask[index] & 2**25) != 0:
+            continue
+        ivar_total[log_lambda_bin] += ivar_exp[index]
+        flux_total[log_lambda_bin] += ivar_exp[index] * flux_exp[index]
+
 
 def exp_diff(hdul, log_lambda):
     """Compute the difference between exposures.
@@ -41,38 +88,33 @@ def exp_diff(hdul, log_lambda):
     The difference between exposures
     """
     num_exp_per_col = hdul[0].read_header()['NEXP'] // 2
+
+    if num_exp_per_col < 2:
+        module_logger.debug("Not enough exposures for diff")
+
     flux_total_odd = np.zeros(log_lambda.size)
     ivar_total_odd = np.zeros(log_lambda.size)
     flux_total_even = np.zeros(log_lambda.size)
     ivar_total_even = np.zeros(log_lambda.size)
 
-    if num_exp_per_col < 2:
-        module_logger.debug("Not enough exposures for diff")
-
+    # FITS columns are big-endian, and the rebinning kernel only accepts
+    # native byte order
+    log_lambda = np.asarray(log_lambda, dtype=np.float64)
     for index_exp in range(num_exp_per_col):
         for index_col in range(2):
-            log_lambda_exp = hdul[(4 + index_exp +
-                                   index_col * num_exp_per_col)]["loglam"][:]
-            flux_exp = hdul[(4 + index_exp +
-                             index_col * num_exp_per_col)]["flux"][:]
-            ivar_exp = hdul[(4 + index_exp +
-                             index_col * num_exp_per_col)]["ivar"][:]
-            mask = hdul[4 + index_exp + index_col * num_exp_per_col]["mask"][:]
-            log_lambda_bins = np.searchsorted(log_lambda, log_lambda_exp)
-
-            # exclude masks 25 (COMBINEREJ), 23 (BRIGHTSKY)?
-            rebin_ivar_exp = np.bincount(log_lambda_bins,
-                                         weights=ivar_exp * (mask & 2**25 == 0))
-            rebin_flux_exp = np.bincount(log_lambda_bins,
-                                         weights=(ivar_exp * flux_exp *
-                                                  (mask & 2**25 == 0)))
+            exposure = hdul[4 + index_exp + index_col * num_exp_per_col].read(
+                columns=["loglam", "flux", "ivar", "mask"])
+            log_lambda_exp = np.asarray(exposure["loglam"], dtype=np.float64)
+            flux_exp = np.asarray(exposure["flux"], dtype=np.float64)
+            ivar_exp = np.asarray(exposure["ivar"], dtype=np.float64)
+            mask = np.asarray(exposure["mask"], dtype=np.int64)
 
             if index_exp % 2 == 1:
-                flux_total_odd[:len(rebin_ivar_exp) - 1] += rebin_flux_exp[:-1]
-                ivar_total_odd[:len(rebin_ivar_exp) - 1] += rebin_ivar_exp[:-1]
+                _rebin_exposure(log_lambda, log_lambda_exp, flux_exp, ivar_exp,
+                                mask, flux_total_odd, ivar_total_odd)
             else:
-                flux_total_even[:len(rebin_ivar_exp) - 1] += rebin_flux_exp[:-1]
-                ivar_total_even[:len(rebin_ivar_exp) - 1] += rebin_ivar_exp[:-1]
+                _rebin_exposure(log_lambda, log_lambda_exp, flux_exp, ivar_exp,
+                                mask, flux_total_even, ivar_total_even)
 
     w = ivar_total_odd > 0
     flux_total_odd[w] /= ivar_total_odd[w]
@@ -106,17 +148,8 @@ def exp_diff_desi(spec_dict, mask_targetid):
     Returns:
         The difference between exposures
     """
-    ivar_unsorted = np.atleast_2d(spec_dict["IVAR"][mask_targetid])
-    num_exp = ivar_unsorted.shape[0]
-
-    # Putting the lowest ivar exposure at the end if the number of exposures is odd
-    argsort = np.arange(num_exp)
-    if num_exp % 2 == 1:
-        argmin_ivar = np.argmin(np.mean(ivar_unsorted, axis=1))
-        argsort[-1], argsort[argmin_ivar] = argsort[argmin_ivar], argsort[-1]
-
-    flux = np.atleast_2d(spec_dict["FLUX"][mask_targetid])[argsort, :]
-    ivar = ivar_unsorted[argsort, :]
+    ivar = np.atleast_2d(spec_dict["IVAR"][mask_targetid])
+    num_exp = ivar.shape[0]
     if num_exp < 2:
         module_logger.debug("Not enough exposures for diff, Spectra rejected")
         return None
@@ -124,22 +157,28 @@ def exp_diff_desi(spec_dict, mask_targetid):
         module_logger.debug("More than 100 exposures, potentially wrong file "
                             "type and using wavelength axis here, skipping?")
         return None
+    flux = np.atleast_2d(spec_dict["FLUX"][mask_targetid])
+
+    # Putting the lowest ivar exposure at the end if the number of exposures is odd
+    # rows are swapped in place: selecting several exposures returns a copy
+    if num_exp % 2 == 1:
+        argmin_ivar = np.argmin(np.mean(ivar, axis=1))
+        if argmin_ivar != num_exp - 1:
+            ivar[[-1, argmin_ivar]] = ivar[[argmin_ivar, -1]]
+            flux[[-1, argmin_ivar]] = flux[[argmin_ivar, -1]]
 
     # Computing ivar and flux for odd and even exposures
-    ivar_total = np.zeros(flux.shape[1])
-    flux_total_odd = np.zeros(flux.shape[1])
-    ivar_total_odd = np.zeros(flux.shape[1])
-    flux_total_even = np.zeros(flux.shape[1])
-    ivar_total_even = np.zeros(flux.shape[1])
-    for index_exp in range(2 * (num_exp // 2)):
-        flexp = flux[index_exp]
-        ivexp = ivar[index_exp]
-        if index_exp % 2 == 1:
-            flux_total_odd += flexp * ivexp
-            ivar_total_odd += ivexp
-        else:
-            flux_total_even += flexp * ivexp
-            ivar_total_even += ivexp
+    num_pairs = 2 * (num_exp // 2)
+    ivar_total_even = ivar[0:num_pairs:2].sum(axis=0, dtype=float)
+    ivar_total_odd = ivar[1:num_pairs:2].sum(axis=0, dtype=float)
+    flux_total_even = np.einsum("ij,ij->j",
+                                flux[0:num_pairs:2],
+                                ivar[0:num_pairs:2],
+                                dtype=float)
+    flux_total_odd = np.einsum("ij,ij->j",
+                               flux[1:num_pairs:2],
+                               ivar[1:num_pairs:2],
+                               dtype=float)
     ivar_total = ivar.sum(axis=0)
 
     # Masking and dividing flux by ivar
@@ -151,8 +190,12 @@ def exp_diff_desi(spec_dict, mask_targetid):
     # Computing alpha correction
     w = w_odd & w_even & (ivar_total > 0)
     alpha_array = np.ones(flux.shape[1])
-    alpha_array[w] = (1 / np.sqrt(ivar_total[w])) / (0.5 * np.sqrt(
-        (1 / ivar_total_even[w]) + (1 / ivar_total_odd[w])))
+    # (1/sqrt(ivar)) / (0.5*sqrt(1/ivar_even + 1/ivar_odd)) with a single
+    # division and square root
+    ivar_even = ivar_total_even[w]
+    ivar_odd = ivar_total_odd[w]
+    alpha_array[w] = 2. * np.sqrt(ivar_even * ivar_odd /
+                                  (ivar_total[w] * (ivar_even + ivar_odd)))
     diff = 0.5 * (flux_total_even - flux_total_odd) * alpha_array
     return diff
 
@@ -184,23 +227,23 @@ def spectral_resolution(wdisp,
     reso: array of floats
     The spectral resolution
     """
-    reso = wdisp * SPEED_LIGHT * 1.0e-4 * np.log(10.)
+    reso = wdisp * WDISP_TO_KMS
 
     if with_correction:
         lambda_ = np.power(10., log_lambda)
         # compute the wavelength correction
-        correction = 1.267 - 0.000142716 * lambda_ + 1.9068e-08 * lambda_ * lambda_
+        correction = 1.267 + lambda_ * (-0.000142716 + 1.9068e-08 * lambda_)
         correction[lambda_ > 6000.0] = 1.097
 
         # add the fiberid correction
         # fiberids greater than 500 corresponds to the second spectrograph
+        # the correction is scaled down linearly for the 100 fibers closest
+        # to either edge of the spectrograph
         fiberid = fiberid % 500
-        if fiberid < 100:
-            correction = (1. + (correction - 1) * .25 + (correction - 1) * .75 *
-                          (fiberid) / 100.)
-        elif fiberid > 400:
-            correction = (1. + (correction - 1) * .25 + (correction - 1) * .75 *
-                          (500 - fiberid) / 100.)
+        edge_distance = min(fiberid, 500 - fiberid, 100)
+        if edge_distance < 100:
+            scale = .25 + .75 * edge_distance / 100.
+            correction = 1. + (correction - 1) * scale
 
         # apply the correction
         reso *= correction
@@ -238,7 +281,48 @@ def _find_nonzero_abs_min_per_row(reso_matrix, num_rows):
     return nonzero_abs_min_per_row
 
 
-def spectral_resolution_desi(reso_matrix, lambda_):
+@njit(error_model="numpy")
+def _compute_rms_in_pixel(reso_matrix, w):
+    """Compute the Gaussian width of the resolution matrix rows selected by w
+
+    The width is estimated from the ratio of the central diagonal to the
+    diagonals at offsets -2, -1, 1 and 2. Only positive log ratios are used
+    in the average.
+
+    Arguments
+    ---------
+    reso_matrix: 2D array of shape (num_diags, num_rows)
+    Resolution matrix
+
+    w: 1D array of bool
+    Mask selecting the rows to process
+
+    Return
+    ------
+    rms_in_pixel: 1D array
+    An array of size w.sum() with the width of each selected row (in pixels)
+    """
+    num_offdiags = reso_matrix.shape[0] // 2
+    rms_in_pixel = np.empty(np.count_nonzero(w))
+    index = 0
+    for irow in range(reso_matrix.shape[1]):
+        if not w[irow]:
+            continue
+        central = reso_matrix[num_offdiags, irow]
+        total = 0.0
+        norm = 0
+        for offset in (-2, -1, 1, 2):
+            ratio = np.log(central / reso_matrix[num_offdiags + offset, irow])
+            if ratio > 0:
+                total += abs(offset) / np.sqrt(ratio)
+                norm += 1
+        rms_in_pixel[index] = total / np.sqrt(2.) / norm
+        index += 1
+
+    return rms_in_pixel
+
+
+def spectral_resolution_desi(reso_matrix, lambda_, log_lambda=None):
     """Compute the spectral resolution for DESI spectra
 
     Arguments
@@ -249,6 +333,10 @@ def spectral_resolution_desi(reso_matrix, lambda_):
     lambda_: 1D array
     Wavelength (in Angstroms)
 
+    log_lambda: 1D array or None - default: None
+    Logarithm of the wavelength (in Angstroms). If None, it is computed
+    from lambda_
+
     Return
     ------
     reso_in_km_per_s: array
@@ -257,15 +345,16 @@ def spectral_resolution_desi(reso_matrix, lambda_):
     if lambda_ is None:
         return None
 
+    if log_lambda is None:
+        log_lambda = np.log10(lambda_)
     delta_log_lambda = np.empty_like(lambda_)
-    delta_log_lambda[:-1] = np.diff(np.log10(lambda_))
+    delta_log_lambda[:-1] = np.diff(log_lambda)
     #note that this would be the same result as before (except for the missing bug) in
     #case of log-uniform binning, but for linear binning pixel size chenges wrt lambda
     delta_log_lambda[-1] = delta_log_lambda[-2] + (delta_log_lambda[-2] -
                                                    delta_log_lambda[-3])
 
-    num_diags, num_rows = reso_matrix.shape
-    num_offdiags = num_diags // 2
+    num_rows = reso_matrix.shape[1]
 
     # shift every row to a small positive value (not done anymore)
     # new resolution model is then Gaussian + constant
@@ -279,29 +368,18 @@ def spectral_resolution_desi(reso_matrix, lambda_):
     if not np.any(w):
         return np.zeros_like(lambda_), np.zeros_like(lambda_)
 
-    reso = reso_matrix[:, w]  #- shift[w]
-
     #assume reso = A*exp(-(x-central_pixel_pos)**2 / 2 / sigma**2)
     #=> sigma = sqrt((x-central_pixel_pos)/2)**2 / log(A/reso)
     #   A = reso(central_pixel_pos)
     # the following averages over estimates for four symmetric values of x
-    indices = np.array([-2, -1, 1, 2], dtype=int)
+    rms_in_pixel = np.empty_like(lambda_)
+    rms_in_pixel[w] = _compute_rms_in_pixel(reso_matrix, w)
     with warnings.catch_warnings():
         # this ignores all warnings in this part of the code, could in principle
         # specify the exact warnings to be supressed
         warnings.filterwarnings(
             'ignore'
         )
-        ratios = reso[num_offdiags, :] / reso[num_offdiags + indices, :]
-        ratios = np.log(ratios)
-        w2 = ratios > 0
-        norm = np.sum(w2, axis=0)
-        new_ratios = np.zeros_like(ratios)
-        new_ratios[w2] = 1. / np.sqrt(ratios[w2])
-        # ratios = 1./np.sqrt(np.log(ratios))
-
-        rms_in_pixel = np.empty_like(lambda_)
-        rms_in_pixel[w] = np.abs(indices).dot(new_ratios) / np.sqrt(2.) / norm
         rms_in_pixel[~w] = rms_in_pixel[w].mean()
 
         reso_in_km_per_s = (rms_in_pixel * SPEED_LIGHT * delta_log_lambda *
@@ -265,22 +265,15 @@ def spectral_resolution_desi(reso_matrix, log_lambda):
     The average resolution in km/s
     """
     delta_log_lambda = (log_lambda[-1] - log_lambda[0]) / float(len(log_lambda) - 1)
-    reso = np.clip(reso_matrix, 1.0e-6, 1.0e6)
-
-    #
+    # gather the central diagonal and its two neighbours on each side once;
+    # only these rows are clipped, so the rest of the matrix is not copied
+    central = len(reso_matrix) // 2
+    block = np.clip(reso_matrix[central - 2:central + 3], 1.0e-6, 1.0e6)
     rms_in_pixel = (
-        np.sqrt(
-            1.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 - 1][:])
-        )
-        + np.sqrt(
-            4.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 - 2][:])
-        )
-        + np.sqrt(
-            1.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 + 1][:])
-        )
-        + np.sqrt(
-            4.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 + 2][:])
-        )
+        np.sqrt(1.0 / 2.0 / np.log(block[2] / block[1]))
+        + np.sqrt(4.0 / 2.0 / np.log(block[2] / block[0]))
+        + np.sqrt(1.0 / 2.0 / np.log(block[2] / block[3]))
+        + np.sqrt(4.0 / 2.0 / np.log(block[2] / block[4]))
     ) / 4.0
 
     avg_reso_in_km_per_s = rms_in_pixel * SPEED_LIGHT * delta_log_lambda * np.log(10.0)
@@ -1,4 +1,5 @@
 """This file contains tests related to AstronomicalObject and its childs"""
+import pickle
 import unittest
 
 import healpy
@@ -455,6 +456,7 @@ class AstronomicalObjectTest(AbstractTest):
     test_desi_pk1d_forest_get_data
     test_desi_pk1d_forest_get_header
     test_forest
+    test_forest_bins
     test_forest_coadd
     test_forest_get_data
     test_forest_get_header
@@ -1508,6 +1510,50 @@ class AstronomicalObjectTest(AbstractTest):
             test_obj.rebin()
         self.compare_error_message(context_manager, expected_message)
 
+    def test_forest_bins(self):
+        """Test the cached binning solutions in Forest."""
+        setup_forest(wave_solution="log", rebin=3)
+        kwargs_forest_log = get_kwargs_input("log", "1")
+
+        test_obj = Forest(**kwargs_forest_log)
+        test_obj.rebin()
+
+        bins = test_obj.log_lambda_bins
+        self.assertTrue(np.array_equal(
+            bins, Forest.find_bins(test_obj.log_lambda, Forest.log_lambda_grid)))
+        self.assertTrue(test_obj.log_lambda_bins is bins)
+
+        rest_frame_bins = test_obj.log_lambda_rest_frame_bins
+        self.assertTrue(np.array_equal(
+            rest_frame_bins,
+            Forest.find_bins(test_obj.log_lambda - np.log10(1 + test_obj.z),
+                             Forest.log_lambda_rest_frame_grid)))
+        self.assertTrue(test_obj.log_lambda_rest_frame_bins is rest_frame_bins)
+
+        index, fraction = test_obj.log_lambda_rest_frame_interp
+        values = Forest.log_lambda_rest_frame_grid**2
+        self.assertTrue(np.allclose(
+            values[index] + fraction * (values[index + 1] - values[index]),
+            np.interp(test_obj.log_lambda - np.log10(1 + test_obj.z),
+                      Forest.log_lambda_rest_frame_grid, values)))
+
+        # replacing log_lambda (e.g. when masking) invalidates the cache
+        test_obj.log_lambda = test_obj.log_lambda[1:]
+        self.assertTrue(np.array_equal(test_obj.log_lambda_bins, bins[1:]))
+        self.assertTrue(np.array_equal(test_obj.log_lambda_rest_frame_bins,
+                                       rest_frame_bins[1:]))
+
+        # replacing the grids invalidates the cache
+        bins = test_obj.log_lambda_bins
+        Forest.log_lambda_grid = Forest.log_lambda_grid[1:]
+        self.assertTrue(np.array_equal(test_obj.log_lambda_bins, bins - 1))
+
+        # the cache is not pickled
+        self.assertTrue(len(test_obj._bins_cache) > 0)
+        unpickled_obj = pickle.loads(pickle.dumps(test_obj))
+        self.assertTrue(len(unpickled_obj._bins_cache) == 0)
+        self.assertTrue(np.array_equal(unpickled_obj.log_lambda_bins, bins - 1))
+
     def test_forest_coadd(self):
         """Test the coadd function in Forest."""
         # set class variables; case: logarithmic wavelength solution
@@ -4,6 +4,7 @@ import logging
 import os
 import unittest
 import copy
+import fitsio
 import numpy as np
 
 from picca.delta_extraction.astronomical_objects.desi_forest import DesiForest
@@ -28,6 +29,7 @@ from picca.delta_extraction.errors import DataError, QuasarCatalogueError
 from picca.delta_extraction.utils import ABSORBER_IGM
 from picca.delta_extraction.utils import ACCEPTED_BLINDING_STRATEGIES
 from picca.delta_extraction.utils import setup_logger
+from picca.delta_extraction.utils_pk1d import exp_diff
 from picca.tests.delta_extraction.abstract_test import AbstractTest
 from picca.tests.delta_extraction.test_utils import reset_logger, setup_test_logger
 from picca.tests.delta_extraction.test_utils import forest1
@@ -49,6 +51,7 @@ class DataTest(AbstractTest):
     test_data_filter_forests
     test_desi_data
     test_desi_data_minisv
+    test_exp_diff
     test_sdss_data_spec
     test_sdss_data_spplate
     """
@@ -1557,6 +1560,55 @@ class DataTest(AbstractTest):
         self.assertTrue(
             all(isinstance(forest, SdssForest) for forest in data.forests))
 
+    def test_exp_diff(self):
+        """Test exp_diff on a spec file with individual exposures"""
+        num_exp = 4
+        log_lambda = 3.56 + 1e-4 * np.arange(50)
+        log_lambda_exp = (3.56 + 1e-4 * np.arange(-3, 55) - 0.3e-4).astype(
+            np.float32)
+
+        # write a spec file: exposures are stored from HDU 4 onwards
+        filename = f"{THIS_DIR}/results/spec_exp_diff.fits"
+        rng = np.random.default_rng(3)
+        with fitsio.FITS(filename, "rw", clobber=True) as hdul:
+            hdul.write(np.zeros(1), header={"NEXP": num_exp})
+            for _ in range(3):
+                hdul.write({"dummy": np.zeros(1)})
+            for _ in range(num_exp):
+                mask = np.zeros(log_lambda_exp.size, dtype=np.int32)
+                mask[10] = 2**25
+                hdul.write({
+                    "loglam": log_lambda_exp,
+                    "flux": rng.normal(1.0, 0.1, log_lambda_exp.size).astype(
+                        np.float32),
+                    "ivar": rng.uniform(1.0, 2.0, log_lambda_exp.size).astype(
+                        np.float32),
+                    "mask": mask,
+                })
+
+        # compute the expected result with np.bincount
+        flux_totals = np.zeros((2, log_lambda.size))
+        ivar_totals = np.zeros((2, log_lambda.size))
+        with fitsio.FITS(filename) as hdul:
+            for index_exp in range(num_exp // 2):
+                for index_col in range(2):
+                    hdu = hdul[4 + index_exp + index_col * num_exp // 2]
+                    bins = np.searchsorted(log_lambda, hdu["loglam"][:])
+                    weights = hdu["ivar"][:] * (hdu["mask"][:] & 2**25 == 0)
+                    rebin_ivar = np.bincount(bins, weights=weights)
+                    rebin_flux = np.bincount(bins,
+                                             weights=weights * hdu["flux"][:])
+                    num_bins = rebin_ivar.size - 1
+                    flux_totals[index_exp % 2, :num_bins] += rebin_flux[:-1]
+                    ivar_totals[index_exp % 2, :num_bins] += rebin_ivar[:-1]
+            w = ivar_totals > 0
+            flux_totals[w] /= ivar_totals[w]
+            expected_diff = 0.5 * (flux_totals[0] - flux_totals[1])
+
+            exposures_diff = exp_diff(hdul, log_lambda)
+
+        self.assertTrue(np.allclose(exposures_diff, expected_diff))
+
     def test_sdss_data_spplate(self):
         """Tests SdssData when run in spplate mode"""
         # using default  value for 'mode'
@@ -2,6 +2,7 @@
 from configparser import ConfigParser
 import copy
 import os
+import pickle
 import unittest
 
 import numpy as np
@@ -21,6 +22,11 @@ from picca.delta_extraction.expected_fluxes.dr16_expected_flux import (
     defaults as defaults_dr16_expected_flux)
 from picca.delta_extraction.expected_fluxes.true_continuum import (
     TrueContinuum, defaults as defaults_true_continuum)
+from picca.delta_extraction.expected_fluxes.utils import (
+    compute_var_func_bin, compute_weights)
+from picca.delta_extraction.least_squares.least_squares_var_stats import (
+    FUDGE_REF, LeastsSquaresVarStats)
+from picca.delta_extraction.utils import LinearInterpolator, stack_pixels
 from picca.tests.delta_extraction.abstract_test import AbstractTest
 from picca.tests.delta_extraction.test_utils import forest1
 from picca.tests.delta_extraction.test_utils import setup_forest, reset_forest
@@ -36,6 +42,7 @@ class ExpectedFluxTest(AbstractTest):
     -------
     compare_ascii (from AbstractTest)
     compare_fits (from AbstractTest)
+    get_var_stats_fitter
     setUp
     tearDown
     test_expected_flux
@@ -46,9 +53,66 @@ class ExpectedFluxTest(AbstractTest):
     test_dr16_expected_flux_compute_mean_cont_lin
     test_dr16_expected_flux_compute_mean_cont_log
     test_dr16_expected_flux_compute_var_stats
+    test_dr16_expected_flux_compute_var_stats_parallel
+    test_dr16_expected_flux_compute_var_stats_scipy
     test_dr16_expected_flux_populate_los_ids
     test_dr16_expected_flux_save_iteration_step
+    test_least_squares_var_stats_derivatives
+    test_linear_interpolator
+    test_stack_pixels
+    test_compute_weights
     """
+    def get_var_stats_fitter(self):
+        """Build the fitter of the variance functions from the test data
+
+        Return
+        ------
+        expected_flux: Dr16ExpectedFlux
+        The expected flux instance used to compute the forest continua
+
+        leasts_squares: LeastsSquaresVarStats
+        The fitter class, initialized with the statistics of the deltas
+        """
+        setup_forest("lin")
+
+        config = ConfigParser()
+        config.read_dict({
+            "data": desi_healpix_kwargs,
+            "expected flux": {
+                "iter out prefix": "iter_out_prefix",
+                "out dir": f"{THIS_DIR}/results/",
+                "num processors": 1,
+            },
+        })
+        for key, value in defaults_dr16_expected_flux.items():
+            if key not in config["expected flux"]:
+                config["expected flux"][key] = str(value)
+        for key, value in defaults_desi_healpix.items():
+            if key not in config["data"]:
+                config["data"][key] = str(value)
+        data = DesiHealpix(config["data"])
+        expected_flux = Dr16ExpectedFlux(config["expected flux"])
+
+        for forest in data.forests:
+            (cont_model, bad_continuum_reason,
+             _) = compute_continuum(forest,
+                                    expected_flux.get_mean_cont,
+                                    expected_flux.get_eta,
+                                    expected_flux.get_var_lss,
+                                    expected_flux.get_fudge,
+                                    expected_flux.use_constant_weight,
+                                    expected_flux.order)
+            forest.bad_continuum_reason = bad_continuum_reason
+            forest.continuum = cont_model
+
+        leasts_squares = LeastsSquaresVarStats(
+            expected_flux.num_bins_variance,
+            data.forests,
+            expected_flux.log_lambda_var_func_grid,
+            expected_flux.min_num_qso_in_fit,
+        )
+        return expected_flux, leasts_squares
+
     def test_dr16_expected_flux(self):
         """Test constructor for class Dr16ExpectedFlux
         Load an Dr16ExpectedFlux instance.
@@ -77,7 +141,7 @@ class ExpectedFluxTest(AbstractTest):
 
         self.assertTrue(isinstance(expected_flux.get_eta, interp1d))
         self.assertTrue(isinstance(expected_flux.get_fudge, interp1d))
-        self.assertTrue(isinstance(expected_flux.get_mean_cont, interp1d))
+        self.assertTrue(isinstance(expected_flux.get_mean_cont, LinearInterpolator))
         self.assertTrue(isinstance(expected_flux.get_var_lss, interp1d))
         self.assertTrue(isinstance(expected_flux.log_lambda_var_func_grid, np.ndarray))
 
@@ -88,7 +152,7 @@ class ExpectedFluxTest(AbstractTest):
 
         self.assertTrue(isinstance(expected_flux.get_eta, interp1d))
         self.assertTrue(isinstance(expected_flux.get_fudge, interp1d))
-        self.assertTrue(isinstance(expected_flux.get_mean_cont, interp1d))
+        self.assertTrue(isinstance(expected_flux.get_mean_cont, LinearInterpolator))
         self.assertTrue(isinstance(expected_flux.get_var_lss, interp1d))
         self.assertTrue(isinstance(expected_flux.log_lambda_var_func_grid, np.ndarray))
 
@@ -424,7 +488,7 @@ class ExpectedFluxTest(AbstractTest):
         for iteration in range(1, 5):
             self.compare_fits(
                 test_file.replace(".fits", f"_iteration{iteration}.fits"),
-                out_file.replace(".fits", f"_iteration{iteration}.fits"))
+                out_file.replace(".fits.gz", f"_iteration{iteration}.fits"))
         self.compare_fits(test_file, out_file)
 
     def test_dr16_expected_flux_compute_expected_flux_log(self):
@@ -461,7 +525,7 @@ class ExpectedFluxTest(AbstractTest):
         for iteration in range(1, 5):
             self.compare_fits(
                 test_file.replace(".fits", f"_iteration{iteration}.fits"),
-                out_file.replace(".fits", f"_iteration{iteration}.fits"))
+                out_file.replace(".fits.gz", f"_iteration{iteration}.fits"))
         self.compare_fits(test_file, out_file)
 
     def test_dr16_expected_flux_compute_mean_cont_lin(self):
@@ -736,6 +800,102 @@ class ExpectedFluxTest(AbstractTest):
         self.assertTrue(np.allclose(num_pixels, expectations["num_pixels"]))
         self.assertTrue(np.allclose(valid_fit, expectations["valid_fit"]))
 
+    def test_dr16_expected_flux_compute_var_stats_parallel(self):
+        """Test that method compute_var_stats for class Dr16ExpectedFlux gives
+        the same results when the bins are fitted in parallel
+        """
+        setup_forest("lin")
+
+        # initialize Data and Dr16ExpectedFlux instances
+        config = ConfigParser()
+        config.read_dict({
+            "data": desi_healpix_kwargs,
+            "expected flux serial": {
+                "iter out prefix": "iter_out_prefix",
+                "out dir": f"{THIS_DIR}/results/",
+                "num processors": 1,
+            },
+            "expected flux parallel": {
+                "iter out prefix": "iter_out_prefix",
+                "out dir": f"{THIS_DIR}/results/",
+                "num processors": 2,
+            },
+        })
+        for section in ["expected flux serial", "expected flux parallel"]:
+            for key, value in defaults_dr16_expected_flux.items():
+                if key not in config[section]:
+                    config[section][key] = str(value)
+        for key, value in defaults_desi_healpix.items():
+            if key not in config["data"]:
+                config["data"][key] = str(value)
+        data = DesiHealpix(config["data"])
+        expected_flux_serial = Dr16ExpectedFlux(config["expected flux serial"])
+        expected_flux_parallel = Dr16ExpectedFlux(
+            config["expected flux parallel"])
+
+        # compute the forest continua
+        for forest in data.forests:
+            (cont_model, bad_continuum_reason,
+             _) = compute_continuum(forest,
+                                    expected_flux_serial.get_mean_cont,
+                                    expected_flux_serial.get_eta,
+                                    expected_flux_serial.get_var_lss,
+                                    expected_flux_serial.get_fudge,
+                                    expected_flux_serial.use_constant_weight,
+                                    expected_flux_serial.order)
+            forest.bad_continuum_reason = bad_continuum_reason
+            forest.continuum = cont_model
+
+        # compute variance functions and statistics
+        expected_flux_serial.compute_var_stats(data.forests)
+        expected_flux_parallel.compute_var_stats(data.forests)
+
+        # compare the results
+        log_lambda = expected_flux_serial.log_lambda_var_func_grid
+        for function in ["get_eta", "get_var_lss", "get_fudge",
+                         "get_num_pixels", "get_valid_fit"]:
+            self.assertTrue(np.allclose(
+                getattr(expected_flux_parallel, function)(log_lambda),
+                getattr(expected_flux_serial, function)(log_lambda)))
+
+    def test_dr16_expected_flux_compute_var_stats_scipy(self):
+        """Test that fitting the variance functions with scipy gives the same
+        results as with iminuit
+        """
+        expected_flux, leasts_squares = self.get_var_stats_fitter()
+        log_lambda = expected_flux.log_lambda_var_func_grid
+        eta = expected_flux.get_eta(log_lambda)
+        var_lss = expected_flux.get_var_lss(log_lambda)
+        fudge = expected_flux.get_fudge(log_lambda)
+
+        num_valid_fits = 0
+        for index in range(expected_flux.num_bins_variance):
+            results = {}
+            for variance_fitter in ["iminuit", "scipy"]:
+                results[variance_fitter] = compute_var_func_bin(
+                    leasts_squares, index, eta[index], var_lss[index],
+                    fudge[index], expected_flux.limit_eta,
+                    expected_flux.limit_var_lss,
+                    expected_flux.fit_variance_functions, variance_fitter)
+            (valid_iminuit, eta_iminuit, var_lss_iminuit, fudge_iminuit,
+             chi2_iminuit, num_pixels_iminuit) = results["iminuit"]
+            (valid_scipy, eta_scipy, var_lss_scipy, fudge_scipy,
+             chi2_scipy, num_pixels_scipy) = results["scipy"]
+
+            self.assertTrue(num_pixels_iminuit == num_pixels_scipy)
+            if not (valid_iminuit and valid_scipy):
+                continue
+            num_valid_fits += 1
+            self.assertTrue(np.isclose(chi2_scipy, chi2_iminuit, rtol=1e-3))
+            self.assertTrue(np.isclose(eta_scipy, eta_iminuit,
+                                       rtol=1e-2, atol=1e-3))
+            self.assertTrue(np.isclose(var_lss_scipy, var_lss_iminuit,
+                                       rtol=1e-2, atol=1e-3))
+            self.assertTrue(np.isclose(fudge_scipy / FUDGE_REF,
+                                       fudge_iminuit / FUDGE_REF,
+                                       rtol=1e-2, atol=1e-2))
+        self.assertTrue(num_valid_fits > 0)
+
     def test_dr16_expected_flux_parse_config(self):
         """Test method __parse_config for class Dr16ExpectedFlux"""
         # Forest variables need to be initialize to finish ExpectedFlux.__init__
@@ -908,6 +1068,40 @@ class ExpectedFluxTest(AbstractTest):
             Dr16ExpectedFlux(config["expected_flux"])
         self.compare_error_message(context_manager, expected_message)
 
+        # create a Dr16ExpectedFlux with missing variance_fitter
+        config = ConfigParser()
+        config.read_dict({"expected_flux": {
+            "iter out prefix": f"iter_out_prefix",
+            "out dir": f"{THIS_DIR}/results/",
+            "num bins variance": 20,
+            "num processors": 1,
+            "var lss mod": 1.0,
+            "force stack delta to zero": True,
+            "limit eta": "0.0, 1.90",
+            "limit var lss": "0.0, 1.90",
+            "min num qso in fit": 100,
+            "num iterations": 5,
+            "order": 1,
+            "use constant weight": False,
+            "use ivar as weight": False,
+        }})
+        expected_message = (
+            "Missing argument 'variance fitter' required by Dr16ExpectedFlux"
+        )
+        with self.assertRaises(ExpectedFluxError) as context_manager:
+            Dr16ExpectedFlux(config["expected_flux"])
+        self.compare_error_message(context_manager, expected_message)
+
+        # create a Dr16ExpectedFlux with invalid variance_fitter
+        config["expected_flux"]["variance fitter"] = "migrad"
+        expected_message = (
+            "Unrecognised value for 'variance fitter'. Expected either "
+            "'iminuit' or 'scipy'. Found 'migrad'."
+        )
+        with self.assertRaises(ExpectedFluxError) as context_manager:
+            Dr16ExpectedFlux(config["expected_flux"])
+        self.compare_error_message(context_manager, expected_message)
+
         # create a Dr16ExpectedFlux instance; case: limit eta and limit var_lss with ()
         config = ConfigParser()
         config.read_dict({"expected_flux": {
@@ -924,6 +1118,7 @@ class ExpectedFluxTest(AbstractTest):
             "order": 1,
             "use constant weight": False,
             "use ivar as weight": False,
+            "variance fitter": "iminuit",
         }})
         expected_flux = Dr16ExpectedFlux(config["expected_flux"])
         self.assertTrue(np.allclose(expected_flux.limit_eta, (0.0, 1.9)))
@@ -945,6 +1140,7 @@ class ExpectedFluxTest(AbstractTest):
             "order": 1,
             "use constant weight": False,
             "use ivar as weight": False,
+            "variance fitter": "iminuit",
         }})
         expected_flux = Dr16ExpectedFlux(config["expected_flux"])
         self.assertTrue(np.allclose(expected_flux.limit_eta, (0.0, 1.9)))
@@ -967,6 +1163,7 @@ class ExpectedFluxTest(AbstractTest):
             "order": 1,
             "use constant weight": False,
             "use ivar as weight": False,
+            "variance fitter": "iminuit",
         }})
         expected_flux = Dr16ExpectedFlux(config["expected_flux"])
         self.assertTrue(np.allclose(expected_flux.limit_eta, (0.0, 1.9)))
@@ -1020,7 +1217,7 @@ class ExpectedFluxTest(AbstractTest):
         linear wavelength solution"""
         setup_forest("lin")
 
-        out_file = f"{THIS_DIR}/results/Log/iter_out_prefix_lin_iteration1.fits.gz"
+        out_file = f"{THIS_DIR}/results/Log/iter_out_prefix_lin_iteration1.fits"
         out_file2 = f"{THIS_DIR}/results/Log/iter_out_prefix_lin.fits.gz"
         test_file = f"{THIS_DIR}/data/iter_out_prefix_lin_iteration1.fits.gz"
         test_file2 = f"{THIS_DIR}/data/iter_out_prefix_lin.fits.gz"
@@ -1045,8 +1242,11 @@ class ExpectedFluxTest(AbstractTest):
         expected_flux = Dr16ExpectedFlux(config["expected flux"])
 
         # compute the forest continua
-        continuum_fit_parameters_dict = {}
-        for forest in data.forests:
+        expected_flux.continuum_fit_los_ids = np.array(
+            [forest.los_id for forest in data.forests])
+        expected_flux.continuum_fit_parameters = np.full(
+            (len(data.forests), 4), np.nan)
+        for index, forest in enumerate(data.forests):
             (cont_model, bad_continuum_reason,
              continuum_fit_parameters) = compute_continuum(forest,
                                                            expected_flux.get_mean_cont,
@@ -1057,8 +1257,8 @@ class ExpectedFluxTest(AbstractTest):
                                                            expected_flux.order)
             forest.bad_continuum_reason = bad_continuum_reason
             forest.continuum = cont_model
-            continuum_fit_parameters_dict[forest.los_id] = continuum_fit_parameters
-        expected_flux.continuum_fit_parameters = continuum_fit_parameters_dict
+            expected_flux.continuum_fit_parameters[
+                index] = continuum_fit_parameters
 
         # compute variance functions and statistics
         expected_flux.compute_delta_stack(data.forests)
@@ -1077,7 +1277,7 @@ class ExpectedFluxTest(AbstractTest):
         logarithmic wavelength solution"""
         setup_forest("log", rebin=3)
 
-        out_file = f"{THIS_DIR}/results/Log/iter_out_prefix_log_iteration1.fits.gz"
+        out_file = f"{THIS_DIR}/results/Log/iter_out_prefix_log_iteration1.fits"
         out_file2 = f"{THIS_DIR}/results/Log/iter_out_prefix_log.fits.gz"
         test_file = f"{THIS_DIR}/data/iter_out_prefix_log_iteration1.fits.gz"
         test_file2 = f"{THIS_DIR}/data/iter_out_prefix_log.fits.gz"
@@ -1834,5 +2034,115 @@ class ExpectedFluxTest(AbstractTest):
                 np.loadtxt(test_file)
             ))
 
+    def test_least_squares_var_stats_derivatives(self):
+        """Test the analytic derivatives of LeastsSquaresVarStats against
+        finite differences
+        """
+        _, leasts_squares = self.get_var_stats_fitter()
+
+        # find a bin with enough quasars to contribute to the fit
+        for index in range(leasts_squares.num_bins_variance):
+            leasts_squares.set_fit_bins(index)
+            if leasts_squares.get_residuals(1.0, 0.1, 1.0).size > 0:
+                break
+        self.assertTrue(leasts_squares.get_residuals(1.0, 0.1, 1.0).size > 0)
+
+        # the residuals are linear and the chi2 quadratic in the parameters,
+        # so central differences are exact up to rounding errors
+        params = np.array([1.1, 0.05, 2.0])
+        steps = np.array([1e-3, 1e-3, 1e-3])
+        jacobian = leasts_squares.get_residuals_jacobian(*params)
+        gradient = leasts_squares.get_gradient(*params)
+        for index_param in range(params.size):
+            params_up = params.copy()
+            params_up[index_param] += steps[index_param]
+            params_down = params.copy()
+            params_down[index_param] -= steps[index_param]
+
+            numerical_jacobian = (
+                leasts_squares.get_residuals(*params_up) -
+                leasts_squares.get_residuals(*params_down)) / (
+                    2 * steps[index_param])
+            self.assertTrue(np.allclose(jacobian[:, index_param],
+                                        numerical_jacobian,
+                                        rtol=1e-5, atol=1e-8))
+
+            numerical_gradient = (leasts_squares(*params_up) -
+                                  leasts_squares(*params_down)) / (
+                                      2 * steps[index_param])
+            self.assertTrue(np.isclose(gradient[index_param],
+                                       numerical_gradient,
+                                       rtol=1e-4, atol=1e-6))
+
+    def test_linear_interpolator(self):
+        """Test that LinearInterpolator reproduces scipy's interp1d"""
+        x = np.linspace(3.0, 3.5, 20)
+        y = np.sin(10 * x) + 2
+        x_eval = np.linspace(2.9, 3.6, 101)
+
+        # extrapolation
+        interp = LinearInterpolator(x, y, fill_value="extrapolate")
+        reference = interp1d(x, y, fill_value="extrapolate")
+        self.assertTrue(np.allclose(interp(x_eval), reference(x_eval)))
+        self.assertTrue(np.isclose(interp(3.6), reference(3.6)))
+
+        # fixed value outside the range
+        interp = LinearInterpolator(x, y, fill_value=0.0)
+        reference = interp1d(x, y, fill_value=0.0, bounds_error=False)
+        self.assertTrue(np.allclose(interp(x_eval), reference(x_eval)))
+
+        # node comparison, also after pickling
+        self.assertTrue(interp.has_nodes(x.copy()))
+        self.assertFalse(interp.has_nodes(x_eval))
+        interp = pickle.loads(pickle.dumps(interp))
+        self.assertTrue(interp._compared_nodes is None)
+        self.assertTrue(interp.has_nodes(x.copy()))
+
+    def test_stack_pixels(self):
+        """Test that stack_pixels reproduces np.bincount"""
+        bins = np.array([0, 3, 3, 1, 4, 0, 3])
+        values = np.linspace(-0.5, 0.5, bins.size)
+        weights = np.linspace(1.0, 2.0, bins.size)
+        stack_values = np.ones(6)
+        stack_weights = np.ones(6)
+
+        stack_pixels(bins, values, weights, stack_values, stack_weights)
+        self.assertTrue(np.allclose(
+            stack_values,
+            1 + np.bincount(bins, weights=values * weights, minlength=6)))
+        self.assertTrue(np.allclose(
+            stack_weights, 1 + np.bincount(bins, weights=weights, minlength=6)))
+
+        # bins outside the stack raise an error and leave the stacks untouched
+        for bad_bins in [np.array([0, -1]), np.array([0, 6])]:
+            stack_values = np.ones(6)
+            stack_weights = np.ones(6)
+            with self.assertRaises(ValueError):
+                stack_pixels(bad_bins, values[:2], weights[:2], stack_values,
+                             stack_weights)
+            self.assertTrue(np.all(stack_values == 1))
+            self.assertTrue(np.all(stack_weights == 1))
+
+    def test_compute_weights(self):
+        """Test that compute_weights reproduces the vectorized weights"""
+        bins = np.array([0, 2, 2, 1, 3])
+        ivar = np.array([1.0, 0.0, 4.0, 2.0, 0.5])
+        continuum = np.array([1.0, 2.0, 0.5, 1.5, 1.0])
+        eta = np.array([1.0, 1.1, 0.9, 1.2])
+        var_lss = np.array([0.1, 0.2, 0.15, 0.05])
+        fudge = np.array([1e-7, 2e-7, 1e-7, 3e-7])
+        var_lss_mod = 2.0
+
+        weights = compute_weights(bins, ivar, continuum, eta, var_lss, fudge,
+                                  var_lss_mod)
+
+        w = ivar > 0
+        var_pipe = 1. / ivar[w] / continuum[w]**2
+        expected_weights = np.zeros(ivar.size)
+        expected_weights[w] = 1.0 / (eta[bins[w]] * var_pipe +
+                                     var_lss_mod * var_lss[bins[w]] +
+                                     fudge[bins[w]] / var_pipe)
+        self.assertTrue(np.allclose(weights, expected_weights))
+
 if __name__ == '__main__':
     unittest.main()
@@ -9,7 +9,8 @@ import numpy as np
 from picca.delta_extraction.mask import Mask
 from picca.delta_extraction.masks.bal_mask import BalMask
 from picca.delta_extraction.masks.bal_mask import defaults as defaults_bal_mask
-from picca.delta_extraction.masks.lines_mask import LinesMask
+from picca.delta_extraction.masks.lines_mask import (LinesMask,
+                                                     find_masked_pixels)
 from picca.delta_extraction.masks.dla_mask import DlaMask
 from picca.delta_extraction.masks.dla_mask import defaults as defaults_dla_mask
 from picca.delta_extraction.masks.absorber_mask import AbsorberMask
@@ -633,6 +634,21 @@ class MaskTest(AbstractTest):
         """Test LinesMask"""
         # TODO: add test
 
+    def test_lines_mask_find_masked_pixels(self):
+        """Test function find_masked_pixels used by LinesMask"""
+        log_lambda = np.linspace(3.5, 3.6, 11)
+        # ranges are allowed to overlap and to lie outside the forest
+        log_wave_min = np.array([3.515, 3.535, 3.545, 3.7, 3.3])
+        log_wave_max = np.array([3.535, 3.555, 3.552, 3.8, 3.505])
+
+        masked = find_masked_pixels(log_lambda, log_wave_min, log_wave_max)
+
+        expected_masked = np.zeros(log_lambda.size, dtype=bool)
+        for wave_min, wave_max in zip(log_wave_min, log_wave_max):
+            expected_masked |= ((log_lambda >= wave_min) &
+                                (log_lambda < wave_max))
+        self.assertTrue(np.array_equal(masked, expected_masked))
+
     def test_lines_mask_missing_options(self):
             """Test correct error reporting when initializing with missing options
             for class LinesMask